@@ -0,0 +1,120 @@
+"""Vectorized coordinate transforms between DMS, geodetic, ECEF and local ENU frames
+
+Every function accepts scalars or NumPy arrays (broadcast together) and returns arrays,
+so thousands of points convert in a single call. Angles are in decimal degrees, lengths in meters.
+"""
+
+import numpy as np
+
+# Semi-major axis (m) and flattening
+ELLIPSOIDS = {
+    "GRS80": (6378137.0, 1 / 298.257222101),
+    "WGS84": (6378137.0, 1 / 298.257223563),
+}
+
+
+def dms_to_decimal(degrees, minutes=0.0, seconds=0.0):
+    """Convert degrees, minutes, seconds to decimal degrees, the sign is taken from degrees"""
+    degrees = np.asarray(degrees, dtype=np.float64)
+    sign = np.where(np.signbit(degrees), -1.0, 1.0)
+    return sign * (np.abs(degrees) + np.asarray(minutes, dtype=np.float64) / 60 + np.asarray(seconds, dtype=np.float64) / 3600)
+
+
+def decimal_to_dms(decimal):
+    """Convert decimal degrees to a (degrees, minutes, seconds) tuple of arrays, the sign is carried on degrees"""
+    decimal = np.asarray(decimal, dtype=np.float64)
+    sign = np.where(np.signbit(decimal), -1.0, 1.0)
+    total_seconds = np.abs(decimal) * 3600
+    degrees, remainder = np.divmod(total_seconds, 3600)
+    minutes, seconds = np.divmod(remainder, 60)
+    return sign * degrees, minutes, seconds
+
+
+def wrap_longitude(longitude):
+    """Wrap longitudes (e.g. OPUS east longitude in [0, 360)) into [-180, 180)"""
+    return (np.asarray(longitude, dtype=np.float64) + 180) % 360 - 180
+
+
+def geodetic_to_ecef(latitude, longitude, height, ellipsoid="GRS80"):
+    """Convert geodetic latitude, longitude and ellipsoid height to ECEF X, Y, Z"""
+    a, f = ELLIPSOIDS[ellipsoid]
+    e2 = f * (2 - f)
+
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    height = np.asarray(height, dtype=np.float64)
+
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    n = a / np.sqrt(1 - e2 * sin_lat ** 2)
+
+    x = (n + height) * cos_lat * np.cos(lon)
+    y = (n + height) * cos_lat * np.sin(lon)
+    z = (n * (1 - e2) + height) * sin_lat
+    return x, y, z
+
+
+def ecef_to_geodetic(x, y, z, ellipsoid="GRS80", iterations=2):
+    """Convert ECEF X, Y, Z to geodetic latitude, longitude and ellipsoid height using Bowring's method"""
+    a, f = ELLIPSOIDS[ellipsoid]
+    b = a * (1 - f)
+    e2 = f * (2 - f)
+    ep2 = e2 / (1 - e2)
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    z = np.asarray(z, dtype=np.float64)
+
+    p = np.hypot(x, y)
+    lon = np.arctan2(y, x)
+
+    # Start from the reduced latitude and refine, each pass is accurate to well under a millimeter on earth
+    beta = np.arctan2(z * a, p * b)
+    for _ in range(iterations):
+        lat = np.arctan2(z + ep2 * b * np.sin(beta) ** 3, p - e2 * a * np.cos(beta) ** 3)
+        beta = np.arctan((1 - f) * np.tan(lat))
+
+    sin_lat = np.sin(lat)
+    height = p * np.cos(lat) + z * sin_lat - a * np.sqrt(1 - e2 * sin_lat ** 2)
+    return np.degrees(lat), np.degrees(lon), height
+
+
+def _enu_rotation(latitude, longitude):
+    lat = np.radians(latitude)
+    lon = np.radians(longitude)
+    return np.sin(lat), np.cos(lat), np.sin(lon), np.cos(lon)
+
+
+def ecef_to_enu(x, y, z, latitude, longitude, height, ellipsoid="GRS80"):
+    """Express ECEF points as east, north, up offsets from the origin at latitude, longitude, height"""
+    x0, y0, z0 = geodetic_to_ecef(latitude, longitude, height, ellipsoid)
+    dx, dy, dz = np.asarray(x) - x0, np.asarray(y) - y0, np.asarray(z) - z0
+    sin_lat, cos_lat, sin_lon, cos_lon = _enu_rotation(latitude, longitude)
+
+    east = -sin_lon * dx + cos_lon * dy
+    north = -sin_lat * cos_lon * dx - sin_lat * sin_lon * dy + cos_lat * dz
+    up = cos_lat * cos_lon * dx + cos_lat * sin_lon * dy + sin_lat * dz
+    return east, north, up
+
+
+def enu_to_ecef(east, north, up, latitude, longitude, height, ellipsoid="GRS80"):
+    """Convert east, north, up offsets from the origin at latitude, longitude, height to ECEF points"""
+    x0, y0, z0 = geodetic_to_ecef(latitude, longitude, height, ellipsoid)
+    sin_lat, cos_lat, sin_lon, cos_lon = _enu_rotation(latitude, longitude)
+    east, north, up = np.asarray(east), np.asarray(north), np.asarray(up)
+
+    x = x0 - sin_lon * east - sin_lat * cos_lon * north + cos_lat * cos_lon * up
+    y = y0 + cos_lon * east - sin_lat * sin_lon * north + cos_lat * sin_lon * up
+    z = z0 + cos_lat * north + sin_lat * up
+    return x, y, z
+
+
+def geodetic_to_enu(latitude, longitude, height, origin, ellipsoid="GRS80"):
+    """East, north, up offsets of geodetic points from origin=(latitude, longitude, height)"""
+    return ecef_to_enu(*geodetic_to_ecef(latitude, longitude, height, ellipsoid), *origin, ellipsoid)
+
+
+def translate(latitude, longitude, height, shift, ellipsoid="GRS80"):
+    """Rigidly translate geodetic points by an ECEF shift=(dx, dy, dz), returning new latitude, longitude, height"""
+    x, y, z = geodetic_to_ecef(latitude, longitude, height, ellipsoid)
+    return ecef_to_geodetic(x + shift[0], y + shift[1], z + shift[2], ellipsoid)
@@ -3,16 +3,25 @@
 import argparse
 import imaplib
 import email
-from dataclasses import dataclass
+import json
+import tempfile
+from dataclasses import dataclass, asdict
+from contextlib import closing, nullcontext
+from multiprocessing import Pool
 from datetime import datetime
-from bs4 import BeautifulSoup as bs
+from lxml import etree
 import sqlite3
+import numpy as np
+import pandas
 import requests
 import time
+import math
 import sys
 import dotenv
 import os
 
+import geodesy
+
 dotenv.load_dotenv()
 
 
@@ -21,6 +30,14 @@ EMAIL = os.environ["EMAIL"]
 PASSWORD = os.environ["PASSWORD"]
 SERVER = os.environ["SERVER"]
 ANTENNAS = {"gr5": "TPSGR5          NONE"}
+QUALITY = {
+    "obs_used": 90,
+    "amb_fixed": 50,
+    "rms": 0.03,
+    "peak_to_peak_lat": 0.04,
+    "peak_to_peak_lon": 0.04,
+    "peak_to_peak_el_height": 0.08,
+}
 
 
 @dataclass
@@ -36,6 +53,12 @@ class TconPos:
     e_lon: (float, float, float)
     ellipsoid_height: float
 
+    def llh(self):
+        """Decimal position with longitude wrapped into [-180, 180)"""
+        position = LLH.from_tuples(self.lat, self.e_lon, self.ellipsoid_height)
+        position.longitude = float(geodesy.wrap_longitude(position.longitude))
+        return position
+
 
 @dataclass
 class LLH:
@@ -44,7 +67,13 @@ class LLH:
     height: float
 
     def from_dms(degrees, minutes, seconds):
-        return degrees + (minutes / 60) + (seconds / 3600)
+        return float(geodesy.dms_to_decimal(degrees, minutes, seconds))
+
+    @staticmethod
+    def dms_to_decimal(dms):
+        """Convert an (n, 3) array of degrees, minutes, seconds to decimal degrees"""
+        dms = np.asarray(dms, dtype=np.float64)
+        return geodesy.dms_to_decimal(dms[..., 0], dms[..., 1], dms[..., 2])
 
     @classmethod
     def from_tuples(cls, latitude: (float, float, float), longitude: (float, float, float), height: float):
@@ -72,85 +101,300 @@ class OPUSReport:
     def _parse_time(tm):
         return datetime.fromisoformat(tm.replace("Z", "+00:00"))
 
+    @staticmethod
+    def _walk(root):
+        """Yield (sections, tag, element) for every element in document order, visiting each node once"""
+        stack = [(root, ())]
+        while stack:
+            element, sections = stack.pop()
+            if not isinstance(element.tag, str):
+                continue
+
+            tag = element.tag.rpartition("}")[2].lower()
+            yield sections, tag, element
+
+            if tag in ("position", "data_quality", "lat", "east_long"):
+                sections = sections + (tag,)
+            stack.extend((child, sections) for child in reversed(element))
+
+    @staticmethod
+    def _attr(element, name):
+        for key, value in element.attrib.items():
+            if key.lower() == name:
+                return value
+        raise KeyError(name)
+
     @classmethod
     def from_xml(cls, xml):
-        soup = bs(xml, "lxml")
-
-        solution = soup.find("opus_solution")
-
-        positions = {}
-        for position in solution.findAll("position"):
-            frame = position.find("ref_frame").text.replace("(", " ").split()[0]
-
-            positions[frame] = TconPos(
+        if isinstance(xml, str):
+            xml = xml.encode()
+        root = etree.fromstring(xml, etree.XMLParser(resolve_entities=False, no_network=True, remove_comments=True))
+
+        fields = {}
+        quality = {}
+        positions = []
+        for sections, tag, element in cls._walk(root):
+            if tag == "position":
+                positions.append({})
+            elif "position" in sections:
+                if tag == "coordinate":
+                    positions[-1].setdefault(("coordinate", cls._attr(element, "axis").upper()), element)
+                else:
+                    positions[-1].setdefault((sections[-1], tag), element)
+            elif "data_quality" in sections:
+                quality.setdefault(tag, element)
+                fields.setdefault(tag, element)
+            else:
+                fields.setdefault(tag, element)
+
+        frames = {}
+        for position in positions:
+            frame = position[("position", "ref_frame")].text.replace("(", " ").split()[0]
+
+            frames[frame] = TconPos(
                 name=frame,
-                x=float(position.find("coordinate", axis="X").text),
-                y=float(position.find("coordinate", axis="Y").text),
-                z=float(position.find("coordinate", axis="X").text),
-                xu=float(position.find("coordinate", axis="X")["uncertainty"]),
-                yu=float(position.find("coordinate", axis="Y")["uncertainty"]),
-                zu=float(position.find("coordinate", axis="Z")["uncertainty"]),
+                x=float(position[("coordinate", "X")].text),
+                y=float(position[("coordinate", "Y")].text),
+                z=float(position[("coordinate", "Z")].text),
+                xu=float(cls._attr(position[("coordinate", "X")], "uncertainty")),
+                yu=float(cls._attr(position[("coordinate", "Y")], "uncertainty")),
+                zu=float(cls._attr(position[("coordinate", "Z")], "uncertainty")),
                 lat=(
-                    float(position.find("lat").find("degrees").text),
-                    float(position.find("lat").find("minutes").text),
-                    float(position.find("lat").find("seconds").text),
+                    float(position[("lat", "degrees")].text),
+                    float(position[("lat", "minutes")].text),
+                    float(position[("lat", "seconds")].text),
                 ),
                 e_lon=(
-                    float(position.find("east_long").find("degrees").text),
-                    float(position.find("east_long").find("minutes").text),
-                    float(position.find("east_long").find("seconds").text),
+                    float(position[("east_long", "degrees")].text),
+                    float(position[("east_long", "minutes")].text),
+                    float(position[("east_long", "seconds")].text),
                 ),
-                ellipsoid_height=float(position.find("el_height").text),
+                ellipsoid_height=float(position[("position", "el_height")].text),
             )
+
+        obs = fields["percent_obs_used"]
+        amb = fields["percent_amb_fixed"]
         return OPUSReport(
-            time=cls._parse_time(solution.find("solution_time").text),
-            obs=(
-                int(solution.find("percent_obs_used")["total"]),
-                int(solution.find("percent_obs_used")["used"]),
-                int(solution.find("percent_obs_used").text),
-            ),
-            amb=(
-                int(solution.find("percent_amb_fixed")["total"]),
-                int(solution.find("percent_amb_fixed")["fixed"]),
-                int(solution.find("percent_amb_fixed").text),
-            ),
-            rms=float(solution.find("rms").text),
-            observation_start=cls._parse_time(
-                solution.find("observation_time")["start"]
-            ),
-            observation_end=cls._parse_time(solution.find("observation_time")["end"]),
-            email=solution.find("email").text,
-            antenna=solution.find("name").text,
-            antenna_height=float(solution.find("arp_height").text),
-            accuracy_lat=float(solution.find("data_quality").find("lat").text),
-            accuracy_lon=float(solution.find("data_quality").find("long").text),
-            accuracy_el_height=float(
-                solution.find("data_quality").find("el_height").text
-            ),
-            ITRF2014=positions["ITRF2014"],
-            NAD83=positions["NAD_83"],
-            ortho_height=float(solution.find("ortho_hgt").text),
+            time=cls._parse_time(fields["solution_time"].text),
+            obs=(int(cls._attr(obs, "total")), int(cls._attr(obs, "used")), int(obs.text)),
+            amb=(int(cls._attr(amb, "total")), int(cls._attr(amb, "fixed")), int(amb.text)),
+            rms=float(fields["rms"].text),
+            observation_start=cls._parse_time(cls._attr(fields["observation_time"], "start")),
+            observation_end=cls._parse_time(cls._attr(fields["observation_time"], "end")),
+            email=fields["email"].text,
+            antenna=fields["name"].text,
+            antenna_height=float(fields["arp_height"].text),
+            accuracy_lat=float(quality["lat"].text),
+            accuracy_lon=float(quality["long"].text),
+            accuracy_el_height=float(quality["el_height"].text),
+            ITRF2014=frames["ITRF2014"],
+            NAD83=frames["NAD_83"],
+            ortho_height=float(fields["ortho_hgt"].text),
         )
 
     def print_quality(self, file=sys.stderr):
+        peak_to_peak_valid = (
+            self.accuracy_lat <= QUALITY["peak_to_peak_lat"]
+            and self.accuracy_lon <= QUALITY["peak_to_peak_lon"]
+            and self.accuracy_el_height <= QUALITY["peak_to_peak_el_height"]
+        )
+
         print("QUALITY REPORT", file=file)
         print("-" * 14, file=file)
         print(
-            f"OBS USED [{'VALID' if self.obs[2] > 90 else 'BAD'}]: {self.obs[2]} ({self.obs[1]}/{self.obs[0]})",
+            f"OBS USED [{'VALID' if self.obs[2] > QUALITY['obs_used'] else 'BAD'}]: {self.obs[2]} ({self.obs[1]}/{self.obs[0]})",
             file=file,
         )
         print(
-            f"FIXED AMB [{'VALID' if self.amb[2] > 50 else 'BAD'}]: {self.amb[2]} ({self.amb[1]}/{self.amb[0]})",
+            f"FIXED AMB [{'VALID' if self.amb[2] > QUALITY['amb_fixed'] else 'BAD'}]: {self.amb[2]} ({self.amb[1]}/{self.amb[0]})",
             file=file,
         )
         print(
-            f"OVERALL RMS [{'VALID' if self.rms  <= 0.03 else 'BAD'}]: {self.rms} m",
+            f"OVERALL RMS [{'VALID' if self.rms <= QUALITY['rms'] else 'BAD'}]: {self.rms} m",
+            file=file,
+        )
+        print(
+            f"PEAK-TO-PEAK [{'VALID' if peak_to_peak_valid else 'BAD'}]: Lat {self.accuracy_lat} Lon {self.accuracy_lon} El Hgt {self.accuracy_el_height}",
             file=file,
         )
-        # print(f"peak-to-peak NAD83 [{'VALID' if self.NAD83.accuracy_lat <= 0.04 and self.NAD83.accuracy_lon <= 0.4 and self.NAD83.accuracy_el_height <= 0.08 else 'BAD'}]: Lat {self.NAD83.accuracy_lat} Lon {self.NAD83.accuracy_lon} El Hgt {self.NAD83.accuracy_el_height}", file=file)
-        # print(f"peak-to-peak ITRF2014 [{'VALID' if self.ITRF2014.accuracy_lat <= 0.04 and self.ITRF2014.accuracy_lon <= 0.4 and self.ITRF2014.accuracy_el_height <= 0.08 else 'BAD'}]: Lat {self.ITRF2014.accuracy_lat} Lon {self.ITRF2014.accuracy_lon} El Hgt {self.ITRF2014.accuracy_el_height}", file=file)
         print("-" * 14, file=file)
 
+    def to_json(self):
+        return json.dumps(asdict(self), default=datetime.isoformat)
+
+    @classmethod
+    def from_json(cls, data):
+        report = json.loads(data)
+        for key in ("time", "observation_start", "observation_end"):
+            report[key] = datetime.fromisoformat(report[key])
+        for key in ("obs", "amb"):
+            report[key] = tuple(report[key])
+        for key in ("ITRF2014", "NAD83"):
+            position = report[key]
+            position["lat"] = tuple(position["lat"])
+            position["e_lon"] = tuple(position["e_lon"])
+            report[key] = TconPos(**position)
+
+        return cls(**report)
+
+
+class OPUSArchive:
+    """Local archive of raw OPUS xml and parsed reports keyed by seqnum"""
+
+    METERS_PER_DEGREE = 111_320
+
+    def __init__(self, path="opus_archive.db"):
+        self.db = sqlite3.connect(path)
+
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS reports (
+                seqnum TEXT PRIMARY KEY,
+                xml TEXT NOT NULL,
+                report TEXT NOT NULL,
+                solution_time timestamp NOT NULL,
+                observation_start timestamp NOT NULL,
+                observation_end timestamp NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                height REAL NOT NULL,
+                antenna TEXT,
+                archived_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS reports_observation ON reports(observation_start)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS reports_position ON reports(latitude, longitude)")
+        self.db.commit()
+
+    def __contains__(self, seqnum):
+        return self.db.execute("SELECT 1 FROM reports WHERE seqnum=?", (seqnum,)).fetchone() is not None
+
+    def get(self, seqnum):
+        row = self.db.execute("SELECT report FROM reports WHERE seqnum=?", (seqnum,)).fetchone()
+        if row is None:
+            return None
+
+        return OPUSReport.from_json(row[0])
+
+    def get_xml(self, seqnum):
+        row = self.db.execute("SELECT xml FROM reports WHERE seqnum=?", (seqnum,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add(self, seqnum, xml, report=None):
+        if report is None:
+            report = OPUSReport.from_xml(xml)
+
+        position = report.NAD83.llh()
+
+        self.db.execute("""
+            INSERT INTO reports(seqnum,xml,report,solution_time,observation_start,observation_end,latitude,longitude,height,antenna)
+            VALUES (?,?,?,?,?,?,?,?,?,?)
+            ON CONFLICT(seqnum) DO UPDATE SET xml=excluded.xml,report=excluded.report,solution_time=excluded.solution_time,
+            observation_start=excluded.observation_start,observation_end=excluded.observation_end,latitude=excluded.latitude,
+            longitude=excluded.longitude,height=excluded.height,antenna=excluded.antenna;
+        """, (
+            seqnum,
+            xml,
+            report.to_json(),
+            report.time.isoformat(),
+            report.observation_start.isoformat(),
+            report.observation_end.isoformat(),
+            position.latitude,
+            position.longitude,
+            position.height,
+            report.antenna,
+        ))
+        self.db.commit()
+
+        return report
+
+    def reparse(self):
+        """Rebuild every parsed report from its archived xml, returning how many were parsed and the seconds spent parsing"""
+        rows = self.db.execute("SELECT seqnum, xml FROM reports").fetchall()
+
+        start = time.perf_counter()
+        reports = [OPUSReport.from_xml(xml) for _, xml in rows]
+        elapsed = time.perf_counter() - start
+
+        for (seqnum, xml), report in zip(rows, reports):
+            self.add(seqnum, xml, report)
+
+        return len(rows), elapsed
+
+    def query(self, since=None, until=None, near=None, radius=100.0):
+        """Find archived reports observed between since/until and within radius meters of near=(lat, lon)"""
+        clauses = []
+        params = []
+
+        if since is not None:
+            clauses.append("observation_start >= ?")
+            params.append(since.isoformat())
+
+        if until is not None:
+            clauses.append("observation_start < ?")
+            params.append(until.isoformat())
+
+        if near is not None:
+            latitude, longitude = near
+            lat_delta = radius / self.METERS_PER_DEGREE
+            lon_delta = radius / (self.METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6))
+            clauses.append("latitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?")
+            params.extend([latitude - lat_delta, latitude + lat_delta, longitude - lon_delta, longitude + lon_delta])
+
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.db.execute(f"SELECT seqnum, report FROM reports {where} ORDER BY observation_start", params)
+
+        for seqnum, report in rows:
+            yield seqnum, OPUSReport.from_json(report)
+
+
+def quality_table(reports):
+    """Build a columnar table of (seqnum, OPUSReport) pairs and evaluate every quality check at once"""
+    seqnums, reports = zip(*reports) if reports else ((), ())
+    positions = [report.NAD83 for report in reports]
+
+    table = pandas.DataFrame({
+        "seqnum": pandas.Series(seqnums, dtype=object),
+        "observation_start": pandas.to_datetime([report.observation_start for report in reports], utc=True),
+        "obs_used": np.array([report.obs[2] for report in reports], dtype=np.int64),
+        "amb_fixed": np.array([report.amb[2] for report in reports], dtype=np.int64),
+        "rms": np.array([report.rms for report in reports], dtype=np.float64),
+        "peak_to_peak_lat": np.array([report.accuracy_lat for report in reports], dtype=np.float64),
+        "peak_to_peak_lon": np.array([report.accuracy_lon for report in reports], dtype=np.float64),
+        "peak_to_peak_el_height": np.array([report.accuracy_el_height for report in reports], dtype=np.float64),
+        "latitude": LLH.dms_to_decimal(np.array([position.lat for position in positions], dtype=np.float64).reshape(-1, 3)),
+        "longitude": geodesy.wrap_longitude(LLH.dms_to_decimal(np.array([position.e_lon for position in positions], dtype=np.float64).reshape(-1, 3))),
+        "height": np.array([position.ellipsoid_height for position in positions], dtype=np.float64),
+    })
+
+    table["obs_used_valid"] = table["obs_used"] > QUALITY["obs_used"]
+    table["amb_fixed_valid"] = table["amb_fixed"] > QUALITY["amb_fixed"]
+    table["rms_valid"] = table["rms"] <= QUALITY["rms"]
+    table["peak_to_peak_valid"] = (
+        (table["peak_to_peak_lat"] <= QUALITY["peak_to_peak_lat"])
+        & (table["peak_to_peak_lon"] <= QUALITY["peak_to_peak_lon"])
+        & (table["peak_to_peak_el_height"] <= QUALITY["peak_to_peak_el_height"])
+    )
+    table["valid"] = table[["obs_used_valid", "amb_fixed_valid", "rms_valid", "peak_to_peak_valid"]].all(axis=1)
+
+    # Robust z-score of each solution against the median position, in meters
+    for column, scale in (("latitude", OPUSArchive.METERS_PER_DEGREE), ("longitude", OPUSArchive.METERS_PER_DEGREE), ("height", 1)):
+        offset = (table[column] - table[column].median()) * scale
+        if column == "longitude":
+            offset *= np.cos(np.radians(table["latitude"]))
+        deviation = (offset - offset.median()).abs()
+        mad = deviation.median()
+        if mad > 0:
+            spread = mad / 0.6745
+        else:
+            # More than half the solutions share a position, the mean absolute deviation still sees the rest
+            spread = 1.253314 * deviation.mean()
+        table[f"{column}_zscore"] = offset / spread if spread > 0 else 0.0
+
+    zscores = table[["latitude_zscore", "longitude_zscore", "height_zscore"]].abs()
+    table["outlier"] = ~table["valid"] | (zscores > 3.5).any(axis=1)
+
+    return table
+
 
 @dataclass
 class MjfPoint:
@@ -167,12 +411,7 @@ class MjfPoint:
     fkey_layer: int
 
     def from_mjf_file(mjf):
-        db = sqlite3.connect(mjf)
-        cur = db.cursor()
-
-        points = cur.execute("SELECT * FROM tblSoPoints").fetchall()
-
-        for point in points:
+        for point in read_mjf(mjf):
             i, name, typ, fkey, lat, lon, hgt, ds, st, et, fl = point
 
             yield MjfPoint(
@@ -284,25 +523,85 @@ class OPUS:
         return ident
 
 
-def points_subcommand(args):
-    for file in args.files:
-        print(f"--- {file} ---", file=sys.stderr)
-        for point in MjfPoint.from_mjf_file(file):
-            if args.format == "pretty":
-                print(f"{point.name}: {point.latitude} {point.longitude} {point.height}m")
+MJF_FIELDS = list(MjfPoint.__dataclass_fields__)
 
-            if args.format == "csv":
-                print(point.name, point.latitude, point.longitude, point.height, sep=",")
 
+def read_mjf(file):
+    with closing(sqlite3.connect(file)) as db:
+        return db.execute("SELECT * FROM tblSoPoints").fetchall()
+
+
+def format_mjf(task):
+    """Load one mjf file and render all of its points, run inside the worker pool"""
+    file, fmt = task
+    rows = read_mjf(file)
+
+    if fmt == "pretty":
+        return file, "".join(f"{row[1]}: {row[4]} {row[5]} {row[6]}m\n" for row in rows)
+
+    if fmt == "csv":
+        return file, "".join(f"{row[1]},{row[4]},{row[5]},{row[6]}\n" for row in rows)
+
+    if fmt == "jsonl":
+        encode = json.JSONEncoder().encode
+        return file, "".join(encode({"file": file, **dict(zip(MJF_FIELDS, row))}) + "\n" for row in rows)
+
+    if fmt == "parquet":
+        return file, pandas.DataFrame.from_records(rows, columns=MJF_FIELDS).assign(file=file)
+
+    raise ValueError(f"Unknown format {fmt}")
+
+
+def export_points(files, fmt, out, jobs=8, headers=True):
+    """Load mjf files in a process pool and write their points to out in the order the files were given"""
+    tasks = [(file, fmt) for file in files]
+    with Pool(jobs) as pool:
+        results = pool.imap(format_mjf, tasks, chunksize=max(1, len(tasks) // (jobs * 8)))
+
+        if fmt == "parquet":
+            pandas.concat([frame for _, frame in results], ignore_index=True).to_parquet(out, index=False)
+            return
+
+        with (nullcontext(sys.stdout) if out == "-" else open(out, "w", buffering=1 << 20)) as fp:
+            for file, text in results:
+                if headers and fmt in ("pretty", "csv"):
+                    print(f"--- {file} ---", file=sys.stderr)
+                fp.write(text)
+
+
+def points_subcommand(args):
+    export_points(args.files, args.format, args.out, args.jobs)
+
+
+def points_bench_subcommand(args):
+    with tempfile.TemporaryDirectory() as folder:
+        files = []
+        for index in range(args.files):
+            file = os.path.join(folder, f"job_{index:04d}.mjf")
+            with closing(sqlite3.connect(file)) as db:
+                db.execute("CREATE TABLE tblSoPoints (ID INTEGER PRIMARY KEY, Name TEXT, Type INT, FKey INT, Lat REAL, Lon REAL, "
+                           "Hgt REAL, FKeyDataset INT, StationType INT, ExtraTypeFlags INT, FKeyLayer INT)")
+                db.executemany(
+                    "INSERT INTO tblSoPoints VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                    ((i, f"P{i}", 1, 0, 40.5 + i * 1e-6, -105.0 - i * 1e-6, 1500.0 + i * 1e-3, 0, 0, 0, 0) for i in range(args.points)),
+                )
+                db.commit()
+            files.append(file)
+
+        for fmt in ("csv", "jsonl"):
+            for jobs in sorted({1, args.jobs}):
+                start = time.perf_counter()
+                export_points(files, fmt, os.devnull, jobs, headers=False)
+                print(f"{fmt:<6} jobs={jobs:<3} {time.perf_counter() - start:.3f}s", file=sys.stderr)
+
+
+def fetch_report(opus_request, archive):
+    report = archive.get(opus_request)
+    if report is not None:
+        print(f"Found archived report {opus_request}...", file=sys.stderr)
+        return report
 
-def process_subcommand(args):
     email = TconMail(EMAIL, PASSWORD, SERVER)
-    opus = OPUS(EMAIL)
-    if args.tps:
-        opus_request = opus.request_report(args.tps, ANTENNAS[args.ant], args.hgt)
-        print("Request posted...", file=sys.stderr)
-    elif args.seq:
-        opus_request = args.seq
 
     print("Waiting for email...", file=sys.stderr)
     mail = email.receive(opus_request)
@@ -313,7 +612,89 @@ def process_subcommand(args):
 
     print(f"Found email {opus_request}...")
 
-    report = OPUSReport.from_xml(mail)
+    return archive.add(opus_request, mail)
+
+
+def archive_subcommand(args):
+    archive = OPUSArchive(args.archive)
+
+    for file in args.files:
+        with open(file) as r:
+            seqnum = os.path.splitext(os.path.basename(file))[0]
+            archive.add(seqnum, r.read())
+            print(f"Archived {file} as {seqnum}", file=sys.stderr)
+
+    if args.reparse:
+        count, elapsed = archive.reparse()
+        print(f"Re-parsed {count} reports in {elapsed:.3f}s ({count / max(elapsed, 1e-9):.0f} reports/s)", file=sys.stderr)
+
+    near = tuple(args.near) if args.near else None
+    for seqnum, report in archive.query(args.since, args.until, near, args.radius):
+        position = report.NAD83.llh()
+        print(
+            seqnum,
+            report.observation_start.isoformat(),
+            report.observation_end.isoformat(),
+            position.latitude,
+            position.longitude,
+            position.height,
+            report.obs[2],
+            report.amb[2],
+            report.rms,
+            sep=",",
+        )
+
+
+def quality_subcommand(args):
+    archive = OPUSArchive(args.archive)
+
+    reports = []
+    for file in args.files:
+        with open(file) as r:
+            reports.append((os.path.splitext(os.path.basename(file))[0], OPUSReport.from_xml(r.read())))
+
+    if not args.files:
+        near = tuple(args.near) if args.near else None
+        reports.extend(archive.query(args.since, args.until, near, args.radius))
+
+    if not reports:
+        raise FileNotFoundError("No OPUS reports matched")
+
+    table = quality_table(reports)
+    checks = ["obs_used_valid", "amb_fixed_valid", "rms_valid", "peak_to_peak_valid", "valid"]
+    metrics = ["obs_used", "amb_fixed", "rms", "peak_to_peak_lat", "peak_to_peak_lon", "peak_to_peak_el_height"]
+
+    print(f"QUALITY SUMMARY ({len(table)} reports)")
+    print("-" * 14)
+    print(table[checks].mean().mul(100).round(1).rename("percent passing").to_string())
+    print()
+    print(table[metrics].describe().T.to_string())
+    print()
+    print(f"Position spread (m): Lat {table['latitude'].std() * OPUSArchive.METERS_PER_DEGREE:.3f} "
+          f"Lon {table['longitude'].std() * OPUSArchive.METERS_PER_DEGREE * np.cos(np.radians(table['latitude'].mean())):.3f} "
+          f"El Hgt {table['height'].std():.3f}")
+    print("-" * 14)
+
+    outliers = table[table["outlier"]]
+    print(f"OUTLIERS ({len(outliers)})")
+    if len(outliers):
+        print(outliers[["seqnum", "observation_start", *metrics, "latitude_zscore", "longitude_zscore", "height_zscore", *checks]].to_string(index=False))
+
+    if args.out:
+        table.to_csv(args.out, index=False)
+        print(f"Wrote quality table to {args.out}", file=sys.stderr)
+
+
+def process_subcommand(args):
+    archive = OPUSArchive(args.archive)
+    if args.tps:
+        opus = OPUS(EMAIL)
+        opus_request = opus.request_report(args.tps, ANTENNAS[args.ant], args.hgt)
+        print("Request posted...", file=sys.stderr)
+    elif args.seq:
+        opus_request = args.seq
+
+    report = fetch_report(opus_request, archive)
     report.print_quality()
 
     bases = list(MjfPoint.find_base(args.mjf))
@@ -334,39 +715,47 @@ def process_subcommand(args):
         models.append(report.ITRF2014)
 
     for model in models:
-        corrected_position = LLH.from_tuples(model.lat, model.e_lon, model.ellipsoid_height)
-        corrected_position.longitude -= 360
+        corrected_position = model.llh()
 
         latitude_offset = base.latitude - corrected_position.latitude
         longitude_offset = base.longitude - corrected_position.longitude
         height_offset = base.height - corrected_position.height
 
+        # Rigid ECEF translation that moves the surveyed base onto the OPUS position
+        base_ecef = np.array(geodesy.geodetic_to_ecef(base.latitude, base.longitude, base.height))
+        corrected_ecef = np.array(geodesy.geodetic_to_ecef(corrected_position.latitude, corrected_position.longitude, corrected_position.height))
+        shift = corrected_ecef - base_ecef
+        east, north, up = geodesy.ecef_to_enu(*corrected_ecef, base.latitude, base.longitude, base.height)
+
         print(f"Base Station ({base.name}): {base.latitude} {base.longitude} {base.height}", file=sys.stderr)
         print(f"Corrected Base Station ({base.name}): {corrected_position.latitude} {corrected_position.longitude} {corrected_position.height}", file=sys.stderr)
         print(f"Correction Offsets: {latitude_offset:.14f} {longitude_offset:.14f} {height_offset:.14f}", file=sys.stderr)
+        print(f"Correction ENU (m): {east:.4f} {north:.4f} {up:.4f}", file=sys.stderr)
 
         for mjf_file in args.mjf:
-            points = list(MjfPoint.from_mjf_file(mjf_file))
+            points = [point for point in MjfPoint.from_mjf_file(mjf_file) if point != base]
             output_name = f"{mjf_file.split('/')[-1].strip('.mjf')}_{model.name}_output.csv"
 
+            latitudes = np.array([point.latitude for point in points], dtype=np.float64)
+            longitudes = np.array([point.longitude for point in points], dtype=np.float64)
+            heights = np.array([point.height for point in points], dtype=np.float64)
+
+            if args.shift == "enu":
+                latitudes, longitudes, heights = geodesy.translate(latitudes, longitudes, heights, shift)
+            else:
+                latitudes, longitudes, heights = latitudes - latitude_offset, longitudes - longitude_offset, heights - height_offset
+
             with open(output_name, "w") as fp:
                 print(f"# Base Station ({base.name}): {base.latitude} {base.longitude} {base.height}", file=fp)
                 print(f"# Corrected Base Station ({base.name}): {corrected_position.latitude} {corrected_position.longitude} {corrected_position.height}", file=fp)
                 print(f"# Correction Offsets: {latitude_offset:.14f} {longitude_offset:.14f} {height_offset:.14f}", file=fp)
+                print(f"# Correction ENU (m): {east:.4f} {north:.4f} {up:.4f} ({args.shift} shift applied)", file=fp)
                 print(f"# Original points", file=fp)
                 for point in points:
-                    if point == base:
-                        continue
                     print(f"# {point.name},{point.latitude},{point.longitude},{point.height}", file=fp)
 
-                for point in points:
-                    if point == base:
-                        continue
-                    assert (base.latitude > corrected_position.latitude) == (point.latitude > point.latitude - latitude_offset)
-                    assert (base.longitude > corrected_position.longitude) == (point.longitude > point.longitude - longitude_offset)
-                    assert (base.height > corrected_position.height) == (point.height > point.height - height_offset)
-
-                    print(f"{point.name},{point.latitude-latitude_offset},{point.longitude-longitude_offset},{point.height-height_offset}", file=fp)
+                for point, latitude, longitude, height in zip(points, latitudes, longitudes, heights):
+                    print(f"{point.name},{latitude},{longitude},{height}", file=fp)
 
             print(f"Wrote corrected values for {mjf_file} to {output_name}", file=sys.stderr)
 
@@ -377,9 +766,17 @@ if __name__ == "__main__":
 
     points_parser = subparsers.add_parser("points", help="Get points from a .mfj file")
     points_parser.add_argument("files", metavar="FILES", nargs="+", help="Mjf files to read and output points")
-    points_parser.add_argument("--format", type=str, default="pretty", choices=["csv", "pretty"])
+    points_parser.add_argument("--format", type=str, default="pretty", choices=["csv", "pretty", "jsonl", "parquet"])
+    points_parser.add_argument("--out", type=str, default="-", help="File to write points to, defaults to stdout")
+    points_parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of mjf files to read in parallel")
     points_parser.set_defaults(func=points_subcommand)
 
+    points_bench_parser = subparsers.add_parser("points-bench", help="Time the points export on a synthetic job folder")
+    points_bench_parser.add_argument("--files", type=int, default=500, help="Number of synthetic mjf files")
+    points_bench_parser.add_argument("--points", type=int, default=200, help="Number of points per mjf file")
+    points_bench_parser.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of mjf files to read in parallel")
+    points_bench_parser.set_defaults(func=points_bench_subcommand)
+
     process_parser = subparsers.add_parser("process", help="Fully process topcon data using Opus")
     tps_group = process_parser.add_mutually_exclusive_group(required=True)
     tps_group.add_argument("--tps", type=str, help="TPS file from base station")
@@ -388,8 +785,34 @@ if __name__ == "__main__":
     process_parser.add_argument("--ant", type=str, required=True, help="Antenna", choices=ANTENNAS.keys())
     process_parser.add_argument("--hgt", type=float, required=True, help="Slant Height")
     process_parser.add_argument("--model", type=str, choices=["NAD83", "ITRF2014", "BOTH"], default="NAD83")
+    process_parser.add_argument("--shift", type=str, choices=["enu", "degrees"], default="enu",
+                                help="Apply the correction as a 3D ECEF/ENU translation or as raw degree offsets")
     process_parser.add_argument("--out", type=str, default="")
+    process_parser.add_argument("--archive", type=str, default="opus_archive.db", help="Local archive of OPUS reports")
     process_parser.set_defaults(func=process_subcommand)
 
+    archive_parser = subparsers.add_parser("archive", help="Import and query locally archived OPUS reports")
+    archive_parser.add_argument("files", metavar="FILES", nargs="*", help="Saved OPUS xml files to import, named by seqnum")
+    archive_parser.add_argument("--archive", type=str, default="opus_archive.db", help="Local archive of OPUS reports")
+    archive_parser.add_argument("--since", type=datetime.fromisoformat, help="Only reports observed on or after this date")
+    archive_parser.add_argument("--until", type=datetime.fromisoformat, help="Only reports observed before this date")
+    archive_parser.add_argument("--near", type=float, nargs=2, metavar=("LAT", "LON"), help="Only reports near this base position")
+    archive_parser.add_argument("--radius", type=float, default=100.0, help="Search radius around --near in meters")
+    archive_parser.add_argument("--reparse", action="store_true", help="Re-parse every archived xml and report throughput")
+    archive_parser.set_defaults(func=archive_subcommand)
+
+    quality_parser = subparsers.add_parser("quality", help="Audit the quality of many OPUS reports at once")
+    quality_parser.add_argument("files", metavar="FILES", nargs="*", help="Saved OPUS xml files, otherwise the archive is used")
+    quality_parser.add_argument("--archive", type=str, default="opus_archive.db", help="Local archive of OPUS reports")
+    quality_parser.add_argument("--since", type=datetime.fromisoformat, help="Only reports observed on or after this date")
+    quality_parser.add_argument("--until", type=datetime.fromisoformat, help="Only reports observed before this date")
+    quality_parser.add_argument("--near", type=float, nargs=2, metavar=("LAT", "LON"), help="Only reports near this base position")
+    quality_parser.add_argument("--radius", type=float, default=100.0, help="Search radius around --near in meters")
+    quality_parser.add_argument("--out", type=str, help="Write the full quality table to this csv")
+    quality_parser.set_defaults(func=quality_subcommand)
+
     args = parser.parse_args()
+    if args.func is points_subcommand and args.format == "parquet" and args.out == "-":
+        points_parser.error("--format parquet needs --out, it can't be written to stdout")
+
     args.func(args)
@@ -0,0 +1,15 @@
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: takes minutes, only runs when selected with -m slow")
+
+
+def pytest_collection_modifyitems(config, items):
+    if "slow" in config.getoption("markexpr"):
+        return
+
+    skip = pytest.mark.skip(reason="slow, select with -m slow")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip)
@@ -2,9 +2,13 @@ __author__ = "Davis Schenkenberger"
 __version__ = "1.0.0"
 
 import argparse
+import heapq
+import json
+import sys
+import numpy as np
 import pandas
-from typing import List
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from abc import ABC, abstractmethod
 
 
@@ -13,7 +17,9 @@ class Process:
     A class representing a process
     """
 
-    def __init__(self, pid, arrival, burst, priority):
+    __slots__ = ("pid", "arrival", "burst", "priority", "waiting_time", "turnaround_time", "remaining", "index")
+
+    def __init__(self, pid, arrival, burst, priority, index=None):
         self.pid = pid
         self.arrival = arrival
         self.burst = burst
@@ -22,6 +28,10 @@ class Process:
         self.waiting_time = 0
         self.turnaround_time = 0
 
+        # Simulation state, the burst time left and the position in the arrival order
+        self.remaining = burst
+        self.index = index
+
     @classmethod
     def from_tuple(cls, t):
         """Create a process from a tuple"""
@@ -32,87 +42,297 @@ class Process:
         return f"Process({self.pid}, {self.arrival}, {self.burst}, {self.priority})"
 
 
-class Processes(list):
-    """A container that holds processes"""
+class Processes:
+    """A columnar table of processes, one NumPy array per field"""
+
+    def __init__(self, pid=(), arrival=(), burst=(), priority=()):
+        self.pid = np.asarray(pid, dtype=np.int64)
+        self.arrival = np.asarray(arrival)
+        self.burst = np.asarray(burst)
+        self.priority = np.asarray(priority, dtype=np.int64)
+
+        times = np.result_type(self.arrival, self.burst)
+        self.waiting_time = np.zeros(len(self.pid), dtype=times)
+        self.turnaround_time = np.zeros(len(self.pid), dtype=times)
 
     @classmethod
     def from_csv(cls, csv):
-        """Generate a list of processes from a pandas dataframe"""
-        a = cls()
-        a.extend([Process.from_tuple(t) for t in csv.itertuples()])
-        return a
+        """Generate a table of processes from a pandas dataframe with pid, arrival, burst and priority columns"""
+        pid, arrival, burst, priority = (csv.iloc[:, column].to_numpy() for column in range(4))
+        return cls(pid, arrival, burst, priority)
+
+    @classmethod
+    def from_processes(cls, processes):
+        """Generate a table from Process objects"""
+        processes = list(processes)
+        return cls(
+            [p.pid for p in processes],
+            [p.arrival for p in processes],
+            [p.burst for p in processes],
+            [p.priority for p in processes],
+        )
+
+    def __len__(self):
+        return len(self.pid)
+
+    def copy(self):
+        processes = Processes(self.pid.copy(), self.arrival.copy(), self.burst.copy(), self.priority.copy())
+        processes.waiting_time = self.waiting_time.copy()
+        processes.turnaround_time = self.turnaround_time.copy()
+        return processes
+
+    def __getitem__(self, index):
+        process = Process(self.pid[index].item(), self.arrival[index].item(), self.burst[index].item(), self.priority[index].item())
+        process.waiting_time = self.waiting_time[index].item()
+        process.turnaround_time = self.turnaround_time[index].item()
+        return process
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def sort(self, *columns):
+        """Reorder every column in place by the given columns, the first one being the primary key"""
+        order = np.lexsort([getattr(self, column) for column in reversed(columns)])
+        for column in ("pid", "arrival", "burst", "priority", "waiting_time", "turnaround_time"):
+            setattr(self, column, getattr(self, column)[order])
+
+    def set_finish_times(self, finish):
+        """Derive turnaround and waiting time from each process' finish time"""
+        self.turnaround_time = np.asarray(finish, dtype=self.turnaround_time.dtype) - self.arrival
+        self.waiting_time = self.turnaround_time - self.burst
 
     def average_waiting_time(self):
         """Calculate average waiting time"""
-        return sum(p.waiting_time for p in self) / len(self)
+        return self.waiting_time.mean()
 
     def average_turnaround_time(self):
         """Calculate average turnaround time"""
-        return sum(p.turnaround_time for p in self) / len(self)
+        return self.turnaround_time.mean()
 
     def print(self, name):
         print(f" {name} ".center(40, "-"))
         print("Process ID | Waiting Time | Turnaround Time")
-        for process in sorted(self, key=lambda p: p.pid):
-            print(
-                f"{process.pid:^11}|{process.waiting_time:^14}|{process.turnaround_time:^16}"
-            )
+        order = np.argsort(self.pid, kind="stable")
+        for pid, waiting_time, turnaround_time in zip(
+            self.pid[order].tolist(), self.waiting_time[order].tolist(), self.turnaround_time[order].tolist()
+        ):
+            print(f"{pid:^11}|{waiting_time:^14}|{turnaround_time:^16}")
 
 
-class GanttChartInfo:
-    """Stores a data entry for the gantt chart"""
+class Arrivals:
+    """An arrival ordered stream of processes read from a sequence of Processes tables, one chunk at a time"""
 
-    def __init__(self, job, start, stop):
-        self.job = job
-        self.start = start
-        self.stop = stop
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._columns = ([], [], [], [])
+        self._position = 0
+        self._count = 0
+        self.next_arrival = None
+        self._load()
 
-    def __repr__(self):
-        return f"[{self.start:^6}]--{self.job:^6}--[{self.stop:^6}]"
+    @classmethod
+    def from_csv(cls, file, chunksize=100_000):
+        """Stream an arrival sorted CSV without loading all of it"""
+        return cls(Processes.from_csv(chunk) for chunk in pandas.read_csv(file, chunksize=chunksize))
+
+    def _load(self):
+        while self._position >= len(self._columns[0]):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self.next_arrival = None
+                return
+
+            chunk.sort("arrival", "pid")
+            if len(chunk) and self.next_arrival is not None and chunk.arrival[0] < self.next_arrival:
+                raise ValueError("Trace must be sorted by arrival time")
+
+            self._columns = (chunk.pid.tolist(), chunk.arrival.tolist(), chunk.burst.tolist(), chunk.priority.tolist())
+            self._position = 0
+
+        self.next_arrival = self._columns[1][self._position]
+
+    def pop(self):
+        """Take the next process off the stream"""
+        pids, arrivals, bursts, priorities = self._columns
+        position = self._position
+        process = Process(pids[position], arrivals[position], bursts[position], priorities[position], self._count)
+
+        self._position += 1
+        self._count += 1
+        if self._position < len(arrivals):
+            self.next_arrival = arrivals[self._position]
+        else:
+            self._load()
+
+        return process
+
+    def pop_until(self, time):
+        """Take every process arriving at or before time"""
+        if self.next_arrival is None or self.next_arrival > time:
+            return ()
+
+        processes = []
+        while self.next_arrival is not None and self.next_arrival <= time:
+            processes.append(self.pop())
+        return processes
 
 
 class GanttChart:
-    """A gantt chart that allows adding data and printing it out"""
+    """A gantt chart stored as parallel job/start/stop arrays, contiguous slices of the same job are merged"""
+
+    IDLE = -1
 
     def __init__(self):
-        self.data = []
+        self._job = np.empty(0, dtype=np.int64)
+        self._start = np.empty(0, dtype=np.int64)
+        self._stop = np.empty(0, dtype=np.int64)
+
+        # Slices added one at a time are buffered in lists and merged into the arrays when they are read
+        self._pending = ([], [], [])
 
     def add(self, job, start, stop):
-        self.data.append(GanttChartInfo(job, start, stop))
+        self._pending[0].append(job)
+        self._pending[1].append(start)
+        self._pending[2].append(stop)
+
+    def extend(self, jobs, starts, stops):
+        """Add many entries at once from parallel sequences"""
+        self._flush()
+        self._append(np.asarray(jobs), np.asarray(starts), np.asarray(stops))
+
+    def _flush(self):
+        if self._pending[0]:
+            jobs, starts, stops = self._pending
+            self._pending = ([], [], [])
+            self._append(np.asarray(jobs), np.asarray(starts), np.asarray(stops))
+
+    def _append(self, jobs, starts, stops):
+        # Only the last stored slice can merge with the new ones
+        jobs = np.concatenate([self._job[-1:], jobs])
+        starts = np.concatenate([self._start[-1:], starts])
+        stops = np.concatenate([self._stop[-1:], stops])
+        if len(jobs) == 0:
+            return
+
+        first = np.ones(len(jobs), dtype=bool)
+        first[1:] = (jobs[1:] != jobs[:-1]) | (starts[1:] != stops[:-1])
+        firsts = np.flatnonzero(first)
+        lasts = np.append(firsts[1:], len(jobs)) - 1
+
+        self._job = np.concatenate([self._job[:-1], jobs[firsts]])
+        self._start = np.concatenate([self._start[:-1], starts[firsts]])
+        self._stop = np.concatenate([self._stop[:-1], stops[lasts]])
+
+    @property
+    def job(self):
+        self._flush()
+        return self._job
+
+    @property
+    def start(self):
+        self._flush()
+        return self._start
+
+    @property
+    def stop(self):
+        self._flush()
+        return self._stop
+
+    def __len__(self):
+        return len(self.job)
 
     def __repr__(self):
-        return f"{self.data}"
+        return f"GanttChart({len(self)} slices)"
 
     def fill_empty(self):
-        for index in range(1, len(self.data)):
-            if self.data[index - 1].stop != self.data[index].start:
-                self.data.insert(
-                    index,
-                    GanttChartInfo(
-                        "IDLE", self.data[index - 1].stop, self.data[index].start
-                    ),
-                )
-
-    def print(self):
+        """Insert IDLE slices into every gap in one pass"""
+        gaps = np.flatnonzero(self.start[1:] != self.stop[:-1]) + 1
+        if len(gaps) == 0:
+            return
+
+        idle_start = self._stop[gaps - 1]
+        idle_stop = self._start[gaps]
+
+        self._job = np.insert(self._job, gaps, self.IDLE)
+        self._start = np.insert(self._start, gaps, idle_start)
+        self._stop = np.insert(self._stop, gaps, idle_stop)
+
+    def rows(self, chunk_size=65536):
+        """Yield (jobs, starts, stops) lists a chunk at a time, IDLE slices have the job "IDLE\""""
+        for offset in range(0, len(self), chunk_size):
+            jobs = self.job[offset:offset + chunk_size]
+            idle = jobs == self.IDLE
+            jobs = jobs.astype(object)
+            jobs[idle] = "IDLE"
+            yield jobs.tolist(), self.start[offset:offset + chunk_size].tolist(), self.stop[offset:offset + chunk_size].tolist()
+
+    def render(self, fmt="text", file=None):
+        """Stream the chart to file (stdout by default) as text, csv or json without building the whole output in memory"""
+        file = file if file is not None else sys.stdout
+
+        if fmt == "csv":
+            file.write("job,start,stop\n")
+        elif fmt == "json":
+            file.write("[")
+
+        separator = ""
+        for jobs, starts, stops in self.rows():
+            if fmt == "text":
+                file.write("".join(f"[{start:^6}]--{job:^6}--[{stop:^6}]\n" for job, start, stop in zip(jobs, starts, stops)))
+            elif fmt == "csv":
+                file.write("".join(f"{job},{start},{stop}\n" for job, start, stop in zip(jobs, starts, stops)))
+            elif fmt == "json":
+                file.write(separator + ",".join(
+                    json.dumps({"job": job, "start": start, "stop": stop}) for job, start, stop in zip(jobs, starts, stops)
+                ))
+                separator = ","
+            else:
+                raise ValueError(f"Unknown format {fmt}")
+
+        if fmt == "json":
+            file.write("]\n")
+
+    def print(self, fmt="text"):
         self.fill_empty()
 
         print("Gantt Chart is:")
-        for row in self.data:
-            print(f"{row}")
+        self.render(fmt)
 
 
 class Scheduler(ABC):
     """Base class for a scheduler"""
 
+    # Whether the schedule depends on the time quantum
+    uses_quantum = False
+
+    # Whether the scheduler takes a cpus argument
+    multicore = False
+
     def __init__(self, processes: Processes, quantum):
-        self.processes: Processes = processes
+        # Work on a copy so schedulers sharing a workload don't reorder or overwrite each other's results
+        self.processes: Processes = processes.copy()
         self.quantum = quantum
         self.gantt = GanttChart()
 
+        self.processes.sort("arrival", "pid")
+
     @abstractmethod
-    def run(self):
+    def simulate(self, arrivals):
+        """Consume an Arrivals stream, yielding each Process with its waiting/turnaround time set as it finishes"""
         return NotImplemented
 
+    def run(self):
+        """Simulate the whole process table and store the results in it"""
+        turnaround = [0] * len(self.processes)
+        for process in self.simulate(Arrivals([self.processes])):
+            turnaround[process.index] = process.turnaround_time
+
+        self.processes.set_finish_times(self.processes.arrival + np.asarray(turnaround))
+
+    def _recorder(self, gantt):
+        """The add method of gantt, or a no-op when the chart isn't kept"""
+        return gantt.add if gantt is not None else _discard
+
     def average_turnaround_time(self):
         return self.processes.average_turnaround_time()
 
@@ -120,135 +340,511 @@ class Scheduler(ABC):
         return self.processes.average_waiting_time()
 
     def calculate_throughput(self):
-        return len(self.processes) / self.gantt.data[-1].stop
+        return len(self.processes) / self.gantt.stop[-1]
+
+    def context_switches(self):
+        """Count switches from one job to a different one, idle time in between doesn't count"""
+        jobs = self.gantt.job[self.gantt.job != GanttChart.IDLE]
+        return int(np.count_nonzero(jobs[1:] != jobs[:-1]))
+
+    def print_gantt(self, fmt="text"):
+        self.gantt.print(fmt)
+
+    def stats(self):
+        return {
+            "average_waiting_time": self.average_waiting_time(),
+            "average_turnaround_time": self.average_turnaround_time(),
+            "throughput": self.calculate_throughput(),
+            "context_switches": self.context_switches(),
+        }
 
     def print_stats(self):
         print(f"Average Waiting Time: {self.average_waiting_time()}")
         print(f"Average Turnaround Time: {self.average_turnaround_time()}")
         print(f"Throughput: {self.calculate_throughput()}")
+        print(f"Context Switches: {self.context_switches()}")
 
 
-class FirstComeFirstServe(Scheduler):
-    def __init__(self, processes: List[Process], quantum: int):
-        super().__init__(processes, quantum)
+def _discard(job, start, stop):
+    pass
 
-        # Sort processes first by arrival, then by pid
-        processes.sort(key=lambda p: (p.arrival, p.pid))
-        self.finish_time = [-1 for _ in self.processes]
 
+def _finished(process, time):
+    process.turnaround_time = time - process.arrival
+    process.waiting_time = process.turnaround_time - process.burst
+    return process
+
+
+class FirstComeFirstServe(Scheduler):
     def run(self):
-        """Iterate through processes, calculate finsh time/waiting time/turnaround time, and add gantt entry"""
-        for index, process in enumerate(self.processes):
-            if index == 0 or process.arrival > self.finish_time[index - 1]:
-                self.finish_time[index] = process.arrival + process.burst
-                self.gantt.add(process.pid, process.arrival, self.finish_time[index])
+        """Calculate finish/waiting/turnaround time and gantt entries for every process at once
+
+        finish[i] = max(arrival[i], finish[i - 1]) + burst[i] unrolls to
+        cumsum(burst)[i] + max(arrival[j] - cumsum(burst)[j - 1] for j <= i), a running maximum.
+        """
+        arrival = self.processes.arrival
+        burst = self.processes.burst
+        total_burst = np.cumsum(burst)
+
+        self.finish_time = total_burst + np.maximum.accumulate(arrival - (total_burst - burst))
+        self.gantt.extend(self.processes.pid, self.finish_time - burst, self.finish_time)
+        self.processes.set_finish_times(self.finish_time)
+
+    def simulate(self, arrivals):
+        """Run each process to completion in arrival order"""
+        add = self._recorder(self.gantt)
+        time = None
+
+        while arrivals.next_arrival is not None:
+            process = arrivals.pop()
+            start = process.arrival if time is None else max(time, process.arrival)
+            time = start + process.burst
+            add(process.pid, start, time)
+            yield _finished(process, time)
+
+
+class HeapScheduler(Scheduler):
+    """Base class for schedulers that run the ready process with the smallest key, advancing by arrival/completion events"""
+
+    preemptive = False
+
+    # Process attribute ranking ready processes, lower goes first. Ties go to the earliest (arrival, pid).
+    key_attribute = "remaining"
+
+    def simulate(self, arrivals):
+        """Pop the best ready process and run it until it finishes or, if preemptive, a better process arrives"""
+        add = self._recorder(self.gantt)
+        key = self.key_attribute
+        ready = []
+        time = arrivals.next_arrival
+
+        while arrivals.next_arrival is not None or ready:
+            if not ready:
+                # Nothing is ready so jump ahead to the next arrival
+                time = max(time, arrivals.next_arrival)
+
+            for process in arrivals.pop_until(time):
+                heapq.heappush(ready, (getattr(process, key), process.index, process))
+
+            _, _, process = heapq.heappop(ready)
+            start = time
+
+            while self.preemptive and arrivals.next_arrival is not None and arrivals.next_arrival < time + process.remaining:
+                # Run up to the next arrival and see if anything that arrived should take over
+                process.remaining -= arrivals.next_arrival - time
+                time = arrivals.next_arrival
+
+                for arrival in arrivals.pop_until(time):
+                    heapq.heappush(ready, (getattr(arrival, key), arrival.index, arrival))
+
+                if ready[0][:2] < (getattr(process, key), process.index):
+                    break
             else:
-                self.finish_time[index] = self.finish_time[index - 1] + process.burst
-                self.gantt.add(
-                    process.pid, self.finish_time[index - 1], self.finish_time[index]
-                )
+                time += process.remaining
+                process.remaining = 0
+
+            add(process.pid, start, time)
 
-            process.turnaround_time = self.finish_time[index] - process.arrival
-            process.waiting_time = (
-                self.finish_time[index] - process.arrival - process.burst
-            )
+            if process.remaining > 0:
+                heapq.heappush(ready, (getattr(process, key), process.index, process))
+            else:
+                yield _finished(process, time)
 
 
-class Priority(FirstComeFirstServe):
-    """Priority queue reuses FCFS since the only difference is sorting"""
+class Priority(HeapScheduler):
+    """Non-preemptive priority scheduling, a lower number is a higher priority"""
+
+    key_attribute = "priority"
+
+
+class PreemptivePriority(Priority):
+    """Priority scheduling where a higher priority arrival preempts the running process"""
+
+    preemptive = True
 
-    def __init__(self, processes: List[Process], quantum: int):
-        super().__init__(processes, quantum)
 
-        # Sort by arrival, then priority and finally pid
-        processes.sort(key=lambda p: (p.arrival, p.priority, p.pid))
-        self.finish_time = [-1 for _ in self.processes]
+class ShortestJobFirst(HeapScheduler):
+    """Non-preemptive shortest job first"""
+
+    key_attribute = "burst"
+
+
+class ShortestRemainingTimeFirst(HeapScheduler):
+    """Preemptive shortest job first, an arrival preempts if it needs less time than what is left of the running process"""
+
+    preemptive = True
+    key_attribute = "remaining"
 
 
 class RoundRobin(Scheduler):
-    def __init__(self, processes, quantum):
+    uses_quantum = True
+
+    def simulate(self, arrivals):
+        """Run one quantum at a time, pulling in arrivals as the clock passes them"""
+        add = self._recorder(self.gantt)
+        queue = deque()
+        time = arrivals.next_arrival
+
+        while arrivals.next_arrival is not None or queue:
+            if not queue:
+                # Nothing is ready so jump ahead to the next arrival
+                queue.append(arrivals.pop())
+                time = max(time, queue[0].arrival)
+
+            process = queue.popleft()
+            t = min(process.remaining, self.quantum)
+            process.remaining -= t
+            add(process.pid, time, time + t)
+            time += t
+
+            # Arrivals during this slice go ahead of the process that was just preempted
+            queue.extend(arrivals.pop_until(time))
+
+            if process.remaining > 0:
+                queue.append(process)
+            else:
+                yield _finished(process, time)
+
+
+class MultilevelFeedbackQueue(Scheduler):
+    """
+    Multilevel feedback queue, level i runs Round Robin with quanta[i]
+
+    Processes arrive at the top level and drop a level whenever they use a full quantum. An arrival preempts
+    a process running below the top level, and every boost_period all processes move back to the top level.
+    """
+
+    uses_quantum = True
+
+    def __init__(self, processes: Processes, quantum, levels=3, quanta=None, boost_period=None):
         super().__init__(processes, quantum)
 
-        self.processes.sort(key=lambda p: (p.arrival, p.pid))
-        self.time = self.processes[0].arrival
-        self.remaining_time = {p.pid: p.burst for p in self.processes}
-        self.unfinished = [p for p in self.processes]
-        self.queue = deque([self.unfinished[0]])
+        self.quanta = list(quanta) if quanta else [quantum * 2 ** level for level in range(levels)]
+        self.boost_period = boost_period if boost_period is not None else 10 * self.quanta[-1]
+
+    def simulate(self, arrivals):
+        """Run one slice at a time, cutting lower level slices short at the next arrival"""
+        add = self._recorder(self.gantt)
+        queues = [deque() for _ in self.quanta]
+        queued = 0
+        time = arrivals.next_arrival
+        next_boost = time + self.boost_period if time is not None else None
+
+        while arrivals.next_arrival is not None or queued:
+            if not queued:
+                # Nothing is ready so jump ahead to the next arrival
+                time = max(time, arrivals.next_arrival)
+
+            for process in arrivals.pop_until(time):
+                queues[0].append(process)
+                queued += 1
+
+            if self.boost_period and time >= next_boost:
+                for queue in queues[1:]:
+                    queues[0].extend(queue)
+                    queue.clear()
+                next_boost += ((time - next_boost) // self.boost_period + 1) * self.boost_period
+
+            level = next(level for level, queue in enumerate(queues) if queue)
+            process = queues[level].popleft()
+            queued -= 1
+
+            stop = time + min(self.quanta[level], process.remaining)
+            if level > 0 and arrivals.next_arrival is not None and arrivals.next_arrival < stop:
+                stop = arrivals.next_arrival
+
+            process.remaining -= stop - time
+            add(process.pid, time, stop)
+            used_quantum = stop - time == self.quanta[level]
+            time = stop
+
+            # Arrivals during this slice go ahead of the process that was just preempted
+            for arrival in arrivals.pop_until(time):
+                queues[0].append(arrival)
+                queued += 1
+
+            if process.remaining == 0:
+                yield _finished(process, time)
+            else:
+                queues[min(level + 1, len(queues) - 1) if used_quantum else level].append(process)
+                queued += 1
+
 
-    def run(self):
-        while sum(self.remaining_time) and len(self.unfinished) > 0:
-            # Iterate while processes have remaining time and there are unfinished jobs
-            if len(self.queue) == 0 and len(self.unfinished) > 0:
-                # Reload the queue if its empty and there are unfinished jobs
-                self.queue.append(self.unfinished[0])
-                self.time = self.queue[0].arrival
-
-            # Use first process in queue
-            process = self.queue[0]
-
-            if self.remaining_time[process.pid] <= self.quantum:
-                # if the remaining time is less than or equal to quantum then we remove the remaining time and add it it to total time
-                t = self.remaining_time[process.pid]
-                self.remaining_time[process.pid] -= t
-                old_time = self.time
-                self.time += t
-
-                self.gantt.add(process.pid, old_time, self.time)
+class CompletelyFair(Scheduler):
+    """
+    CFS-style scheduling, the runnable process with the least weighted virtual runtime goes next
+
+    Lower priority numbers get more weight, so their virtual runtime grows slower. Each pick runs for the
+    process' weighted share of the target latency, but at least one quantum.
+    """
+
+    uses_quantum = True
+
+    def __init__(self, processes: Processes, quantum, latency=None):
+        super().__init__(processes, quantum)
+
+        self.latency = latency if latency is not None else 4 * quantum
+
+    @staticmethod
+    def weight(priority):
+        return 1024 / 1.25 ** (priority - 1)
+
+    def simulate(self, arrivals):
+        """Pop the smallest virtual runtime from a heap, run its slice and push it back"""
+        add = self._recorder(self.gantt)
+        min_vruntime = 0.0
+        total_weight = 0.0
+        ready = []
+        time = arrivals.next_arrival
+
+        while arrivals.next_arrival is not None or ready:
+            if not ready:
+                # Nothing is ready so jump ahead to the next arrival
+                time = max(time, arrivals.next_arrival)
+
+            # New processes start level with the least virtual runtime so they can't starve everyone else
+            for process in arrivals.pop_until(time):
+                heapq.heappush(ready, (min_vruntime, process.index, process))
+                total_weight += self.weight(process.priority)
+
+            min_vruntime, _, process = heapq.heappop(ready)
+            weight = self.weight(process.priority)
+
+            t = min(max(self.quantum, int(self.latency * weight / total_weight)), process.remaining)
+            process.remaining -= t
+            add(process.pid, time, time + t)
+            time += t
+            vruntime = min_vruntime + t * 1024 / weight
+
+            for arrival in arrivals.pop_until(time):
+                heapq.heappush(ready, (min_vruntime, arrival.index, arrival))
+                total_weight += self.weight(arrival.priority)
+
+            if process.remaining > 0:
+                heapq.heappush(ready, (vruntime, process.index, process))
             else:
-                # Otherwise we just remove the quantum
-                self.remaining_time[process.pid] -= self.quantum
-                old_time = self.time
-                self.time += self.quantum
-
-                self.gantt.add(process.pid, old_time, self.time)
-
-            # Add all processes that will arrive at this time to the queue and push the head of the queue to the end
-            self.queue.extend([p for p in self.processes if self.arriving(p)])
-            self.queue.rotate(-1)
-
-            # Remove the process from unfinished and the queue if its done
-            if self.remaining_time[process.pid] == 0:
-                self.queue.remove(process)
-                self.unfinished.remove(process)
-
-            # Calculate turnaround and waiting time
-            process.turnaround_time = self.time - process.arrival
-            process.waiting_time = self.time - process.arrival - process.burst
-
-    def arriving(self, p):
-        """Check if a process is arriving now"""
-        return (
-            p.arrival <= self.time
-            and p is not self.queue[0]
-            and p not in self.queue
-            and p in self.unfinished
-        )
+                total_weight -= weight
+                yield _finished(process, time)
+
+
+class MultiCore(Scheduler):
+    """
+    Round Robin on several CPUs, each with its own run queue and gantt chart
+
+    Arrivals go to the CPU with the least queued and running work, and with stealing enabled
+    a CPU that runs out of work takes the most recently queued process of the busiest CPU.
+    """
+
+    uses_quantum = True
+    multicore = True
+
+    def __init__(self, processes: Processes, quantum, cpus=2, steal=True):
+        super().__init__(processes, quantum)
+
+        self.cpus = cpus
+        self.steal = steal
+        self.gantts = [GanttChart() for _ in range(cpus)]
+        self.migrations = 0
+
+    def simulate(self, arrivals):
+        """Advance from one slice boundary to the next with a heap of (time, cpu) events"""
+        adds = [self._recorder(gantt) for gantt in (self.gantts or [None] * self.cpus)]
+        queues = [deque() for _ in range(self.cpus)]
+        running = [None] * self.cpus
+        idle = set(range(self.cpus))
+        events = []
+
+        def enqueue_arrivals(time):
+            for process in arrivals.pop_until(time):
+                cpu = min(range(self.cpus), key=lambda c: (len(queues[c]) + (running[c] is not None), c))
+                queues[cpu].append(process)
+
+                if cpu in idle:
+                    idle.remove(cpu)
+                    heapq.heappush(events, (time, cpu))
+
+        while events or arrivals.next_arrival is not None:
+            if arrivals.next_arrival is not None and (not events or arrivals.next_arrival < events[0][0]):
+                # Hand the arrival out before the next slice ends so idle CPUs start it right away
+                enqueue_arrivals(arrivals.next_arrival)
+                continue
+
+            time, cpu = heapq.heappop(events)
+            enqueue_arrivals(time)
+
+            process = running[cpu]
+            running[cpu] = None
+            if process is not None:
+                if process.remaining > 0:
+                    queues[cpu].append(process)
+                else:
+                    yield _finished(process, time)
+
+            if not queues[cpu] and self.steal:
+                victim = max(range(self.cpus), key=lambda c: len(queues[c]))
+                if queues[victim]:
+                    queues[cpu].append(queues[victim].pop())
+                    self.migrations += 1
+
+            if not queues[cpu]:
+                idle.add(cpu)
+                continue
+
+            process = queues[cpu].popleft()
+            t = min(process.remaining, self.quantum)
+            process.remaining -= t
+            adds[cpu](process.pid, time, time + t)
+            running[cpu] = process
+            heapq.heappush(events, (time + t, cpu))
+
+    def calculate_throughput(self):
+        return len(self.processes) / max(gantt.stop[-1] for gantt in self.gantts if len(gantt))
+
+    def context_switches(self):
+        switches = 0
+        for gantt in self.gantts:
+            jobs = gantt.job[gantt.job != GanttChart.IDLE]
+            switches += int(np.count_nonzero(jobs[1:] != jobs[:-1]))
+        return switches
+
+    def print_gantt(self, fmt="text"):
+        for cpu, gantt in enumerate(self.gantts):
+            print(f"CPU {cpu}")
+            gantt.print(fmt)
+
+    def stats(self):
+        return {**super().stats(), "migrations": self.migrations}
+
+
+SCHEDULERS = {
+    "FCFS": FirstComeFirstServe,
+    "PS": Priority,
+    "Preemptive PS": PreemptivePriority,
+    "SJF": ShortestJobFirst,
+    "SRTF": ShortestRemainingTimeFirst,
+    "Round Robin": RoundRobin,
+    "MLFQ": MultilevelFeedbackQueue,
+    "CFS": CompletelyFair,
+    "SMP Round Robin": MultiCore,
+}
+
+
+def create_scheduler(name, processes, quantum, cpus=1, steal=True):
+    scheduler = SCHEDULERS[name]
+    return scheduler(processes, quantum, cpus=cpus, steal=steal) if scheduler.multicore else scheduler(processes, quantum)
+
+
+def run_scheduler(task):
+    """Run one scheduler on one workload and return its stats, used as a sweep worker"""
+    workload, processes, name, quantum, cpus, steal = task
+    s = create_scheduler(name, processes, quantum, cpus, steal)
+    s.run()
+    return {
+        "workload": workload,
+        "scheduler": name,
+        "quantum": quantum if s.uses_quantum else None,
+        "cpus": cpus,
+        "steal": steal if s.multicore else None,
+        **s.stats(),
+    }
+
+
+def sweep(workloads, quanta, cpus=(2,), jobs=None, steals=(True,)):
+    """
+    Run every scheduler on every workload in a process pool
+
+    Once per quantum for schedulers that use one, and once per cpu count and work stealing setting for SMP schedulers.
+    """
+    tasks = [
+        (workload, processes, name, quantum, cpu_count, steal)
+        for workload, processes in workloads.items()
+        for name, scheduler in SCHEDULERS.items()
+        for quantum in (quanta if scheduler.uses_quantum else quanta[:1])
+        for cpu_count in (cpus if scheduler.multicore else (1,))
+        for steal in (steals if scheduler.multicore else (True,))
+    ]
+
+    with ProcessPoolExecutor(jobs) as executor:
+        results = pandas.DataFrame(executor.map(run_scheduler, tasks))
+
+    results["quantum"] = results["quantum"].astype("Int64")
+    return results
+
+
+def stream(name, file, quantum, cpus=1, chunksize=100_000, out=None, steal=True):
+    """
+    Schedule an arrival sorted CSV a chunk at a time, writing each process' times to out as it finishes
+
+    Only the processes that have arrived and not finished are held in memory and no gantt chart is kept.
+    """
+    out = out if out is not None else sys.stdout
+    s = create_scheduler(name, Processes(), quantum, cpus, steal)
+    s.gantt = None
+    s.gantts = None
+
+    count = 0
+    total_waiting = 0
+    total_turnaround = 0
+    last_finish = 0
+    for process in s.simulate(Arrivals.from_csv(file, chunksize)):
+        out.write(f"{name},{process.pid},{process.waiting_time},{process.turnaround_time}\n")
+        count += 1
+        total_waiting += process.waiting_time
+        total_turnaround += process.turnaround_time
+        last_finish = max(last_finish, process.arrival + process.turnaround_time)
+
+    return {
+        "scheduler": name,
+        "processes": count,
+        "average_waiting_time": total_waiting / count if count else 0,
+        "average_turnaround_time": total_turnaround / count if count else 0,
+        "throughput": count / last_finish if last_finish else 0,
+    }
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="HW4 CPU Scheduling Algorithms")
-    parser.add_argument(
-        "FILE", type=pandas.read_csv, help="CSV containing process info"
-    )
+    parser.add_argument("FILE", help="CSV containing process info")
     parser.add_argument("QUANTUM", help="Time Quantum")
+    parser.add_argument("--gantt", choices=["text", "csv", "json"], default="text", help="Gantt chart output format")
+    parser.add_argument("--sweep", action="store_true", help="Compare every scheduler over a grid of quanta and workloads")
+    parser.add_argument("--quanta", type=int, nargs="+", help="Quanta to sweep, defaults to QUANTUM")
+    parser.add_argument("--workloads", nargs="+", default=[], help="Additional CSV workloads to sweep")
+    parser.add_argument("--cpus", type=int, nargs="+", default=[2], help="CPUs for SMP scheduling, a sweep runs each count")
+    parser.add_argument("--steal", nargs="+", choices=["on", "off"], default=["on"],
+                        help="Work stealing for SMP scheduling, a sweep runs each setting")
+    parser.add_argument("--jobs", type=int, help="Number of worker processes for the sweep")
+    parser.add_argument("--out", help="Write the sweep results to this CSV")
+    parser.add_argument("--stream", action="store_true", help="Read FILE in chunks and print each process' times as it finishes")
+    parser.add_argument("--chunksize", type=int, default=100_000, help="Rows read at a time when streaming")
+    parser.add_argument("--schedulers", nargs="+", choices=SCHEDULERS.keys(), help="Schedulers to run, defaults to all of them")
 
     args = parser.parse_args()
-
-    processes = Processes.from_csv(args.FILE)
-    schedulers = {
-        "FCFS": FirstComeFirstServe,
-        "PS": Priority,
-        "Round Robin": RoundRobin,
-    }
-
-    # Run each scheduler
-    for name, scheduler in schedulers.items():
-        s = scheduler(processes, int(args.QUANTUM))
-        s.run()
-
-        s.processes.print(name)
-        print()
-        s.gantt.print()
-        print()
-        s.print_stats()
-        print()
+    steals = [setting == "on" for setting in args.steal]
+
+    if args.stream:
+        print("scheduler,pid,waiting_time,turnaround_time")
+        for name in args.schedulers or SCHEDULERS:
+            summary = stream(name, args.FILE, int(args.QUANTUM), args.cpus[0], args.chunksize, steal=steals[0])
+            print(", ".join(f"{key}: {value}" for key, value in summary.items()), file=sys.stderr)
+    elif args.sweep:
+        workloads = {file: Processes.from_csv(pandas.read_csv(file)) for file in [args.FILE, *args.workloads]}
+        results = sweep(workloads, args.quanta or [int(args.QUANTUM)], args.cpus, args.jobs, steals)
+
+        print(results.to_string(index=False))
+        if args.out:
+            results.to_csv(args.out, index=False)
+    else:
+        processes = Processes.from_csv(pandas.read_csv(args.FILE))
+
+        # Run each scheduler
+        for name in args.schedulers or SCHEDULERS:
+            s = create_scheduler(name, processes, int(args.QUANTUM), args.cpus[0], steals[0])
+            s.run()
+
+            s.processes.print(name)
+            print()
+            s.print_gantt(args.gantt)
+            print()
+            s.print_stats()
+            print()
@@ -0,0 +1,37 @@
+"""
+Scheduler run() timings with pytest-benchmark
+
+Save a baseline with --benchmark-autosave and catch regressions against it with
+--benchmark-compare --benchmark-compare-fail=mean:25%. The 10^6 process runs are marked slow.
+"""
+import functools
+
+import pytest
+
+import sch
+import workload
+
+pytest.importorskip("pytest_benchmark")
+
+QUANTUM = 4
+SIZES = [10 ** 3, 10 ** 4, 10 ** 5, pytest.param(10 ** 6, marks=pytest.mark.slow)]
+
+
+@functools.lru_cache(maxsize=None)
+def processes(size):
+    return sch.Processes.from_csv(workload.generate(size, seed=0))
+
+
+@pytest.mark.parametrize("size", SIZES)
+@pytest.mark.parametrize("name", list(sch.SCHEDULERS))
+def test_run(benchmark, name, size):
+    table = processes(size)
+    benchmark.group = name
+    benchmark.extra_info["processes"] = size
+
+    # A fresh scheduler per round, run() fills in the gantt chart and results of the one it's called on
+    benchmark.pedantic(
+        lambda s: s.run(),
+        setup=lambda: ((sch.create_scheduler(name, table, QUANTUM, cpus=2),), {}),
+        rounds=max(3, 10 ** 5 // size),
+    )
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import sch
+import workload
+
+
+def test_multicore_starts_arrivals_on_idle_cpus():
+    processes = sch.Processes([1, 2], [0, 3], [10, 1], [1, 1])
+    s = sch.MultiCore(processes, 10, cpus=2)
+    s.run()
+
+    assert s.processes.waiting_time.tolist() == [0, 0]
+    assert s.migrations == 0
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_multicore_never_waits_with_a_cpu_per_process(seed):
+    processes = sch.Processes.from_csv(workload.generate(50, seed=seed))
+    s = sch.MultiCore(processes, 4, cpus=len(processes))
+    s.run()
+
+    assert np.all(s.processes.waiting_time == 0)
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("rate", [0.01, 0.1, 1.0])
+def test_fcfs_run_matches_simulate(seed, rate):
+    # Low rates leave the CPU idle between arrivals, which the running maximum has to skip over
+    processes = sch.Processes.from_csv(workload.generate(200, rate=rate, seed=seed))
+
+    vectorized = sch.FirstComeFirstServe(processes, 1)
+    vectorized.run()
+    looped = sch.FirstComeFirstServe(processes, 1)
+    sch.Scheduler.run(looped)
+
+    assert np.array_equal(vectorized.processes.waiting_time, looped.processes.waiting_time)
+    assert np.array_equal(vectorized.processes.turnaround_time, looped.processes.turnaround_time)
+    assert np.array_equal(vectorized.gantt.start, looped.gantt.start)
+    assert np.array_equal(vectorized.gantt.stop, looped.gantt.stop)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_multicore_without_stealing_never_migrates(seed):
+    processes = sch.Processes.from_csv(workload.generate(500, rate=1.0, seed=seed))
+    s = sch.create_scheduler("SMP Round Robin", processes, 4, cpus=4, steal=False)
+    s.run()
+
+    assert s.migrations == 0
+    assert np.all(s.processes.waiting_time >= 0)
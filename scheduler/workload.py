@@ -0,0 +1,126 @@
+__author__ = "Davis Schenkenberger"
+__version__ = "1.0.0"
+
+import argparse
+import math
+import sys
+import time
+import numpy as np
+import pandas
+
+import sch
+
+MIN_SECONDS = 0.05
+
+
+def generate(count, rate=0.1, burst_shape=1.5, burst_scale=2.0, max_burst=1000, priorities=5, priority_skew=1.0, seed=None):
+    """
+    Generate a workload with Poisson arrivals, Pareto (heavy-tailed) bursts and Zipf-like priorities
+
+    rate is the mean number of arrivals per time unit, burst_shape is the Pareto tail index (smaller is heavier)
+    and priority_skew makes low priority numbers (high priority) more common as it grows, 0 is uniform.
+    """
+    rng = np.random.default_rng(seed)
+
+    arrival = np.floor(np.cumsum(rng.exponential(1 / rate, count))).astype(np.int64)
+    burst = np.clip(np.ceil((rng.pareto(burst_shape, count) + 1) * burst_scale), 1, max_burst).astype(np.int64)
+
+    weights = 1 / np.arange(1, priorities + 1) ** priority_skew
+    priority = rng.choice(np.arange(1, priorities + 1), size=count, p=weights / weights.sum())
+
+    return pandas.DataFrame({
+        "ProcessID": np.arange(1, count + 1),
+        "ArrivalTime": arrival - arrival[0] if count else arrival,
+        "BurstTime": burst,
+        "Priority": priority,
+    })
+
+
+def time_run(scheduler, processes, quantum, repeat=3):
+    """Seconds per run(), best of repeat, each repeat runs fresh schedulers until MIN_SECONDS have passed"""
+    best = float("inf")
+    for _ in range(repeat):
+        runs = total = 0
+        while total < MIN_SECONDS:
+            s = scheduler(processes, quantum)
+            start = time.perf_counter()
+            s.run()
+            total += time.perf_counter() - start
+            runs += 1
+        best = min(best, total / runs)
+    return best
+
+
+def benchmark(sizes, quantum, seed=0, repeat=3, schedulers=None):
+    """Time each scheduler's run() on generated workloads of each size, best of repeat, yielding one result row at a time"""
+    for size in sizes:
+        processes = sch.Processes.from_csv(generate(size, seed=seed))
+
+        for name, scheduler in (schedulers or sch.SCHEDULERS).items():
+            elapsed = time_run(scheduler, processes, quantum, repeat)
+            yield {"scheduler": name, "processes": size, "seconds": elapsed, "us_per_process": elapsed / size * 1e6}
+
+
+def generate_subcommand(args):
+    workload = generate(
+        args.count, args.rate, args.burst_shape, args.burst_scale, args.max_burst, args.priorities, args.priority_skew, args.seed
+    )
+
+    if args.out.endswith(".parquet"):
+        workload.to_parquet(args.out, index=False)
+    else:
+        workload.to_csv(args.out, index=False)
+
+    print(f"Wrote {args.count} processes to {args.out}", file=sys.stderr)
+
+
+def bench_subcommand(args):
+    rows = []
+    for row in benchmark(args.sizes, args.quantum, args.seed, args.repeat):
+        # Growth exponent against the previous size, ~1 is linear and ~2 is quadratic
+        previous = next((r for r in reversed(rows) if r["scheduler"] == row["scheduler"]), None)
+        row["exponent"] = (
+            math.log(row["seconds"] / previous["seconds"]) / math.log(row["processes"] / previous["processes"])
+            if previous else float("nan")
+        )
+        rows.append(row)
+        print(f"{row['scheduler']:<14}{row['processes']:>10}{row['seconds']:>10.3f}s{row['us_per_process']:>10.2f}us{row['exponent']:>8.2f}")
+
+    results = pandas.DataFrame(rows)
+    if args.out:
+        results.to_csv(args.out, index=False)
+
+    slow = results[results["exponent"] > args.max_exponent]
+    if len(slow):
+        print(f"Superlinear scaling (exponent > {args.max_exponent}):", file=sys.stderr)
+        print(slow.to_string(index=False), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic workloads and benchmark the schedulers in sch.py")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    generate_parser = subparsers.add_parser("generate", help="Write a synthetic workload")
+    generate_parser.add_argument("count", type=int, help="Number of processes")
+    generate_parser.add_argument("out", help="CSV or .parquet file to write")
+    generate_parser.add_argument("--rate", type=float, default=0.1, help="Mean arrivals per time unit")
+    generate_parser.add_argument("--burst-shape", type=float, default=1.5, help="Pareto tail index of burst times")
+    generate_parser.add_argument("--burst-scale", type=float, default=2.0, help="Minimum burst time before rounding")
+    generate_parser.add_argument("--max-burst", type=int, default=1000, help="Cap on burst time")
+    generate_parser.add_argument("--priorities", type=int, default=5, help="Number of priority levels")
+    generate_parser.add_argument("--priority-skew", type=float, default=1.0, help="Zipf exponent of priorities, 0 is uniform")
+    generate_parser.add_argument("--seed", type=int, help="Random seed")
+    generate_parser.set_defaults(func=generate_subcommand)
+
+    bench_parser = subparsers.add_parser("bench", help="Time every scheduler over growing workloads")
+    bench_parser.add_argument("--sizes", type=int, nargs="+", default=[10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6])
+    bench_parser.add_argument("--quantum", type=int, default=4)
+    bench_parser.add_argument("--seed", type=int, default=0)
+    bench_parser.add_argument("--repeat", type=int, default=3, help="Keep the best of this many runs")
+    bench_parser.add_argument("--max-exponent", type=float, default=1.3, help="Fail if runtime grows faster than n^x")
+    bench_parser.add_argument("--out", help="Write the timings to this CSV")
+    bench_parser.set_defaults(func=bench_subcommand)
+
+    args = parser.parse_args()
+    args.func(args)
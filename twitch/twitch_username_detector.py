@@ -1,44 +1,262 @@
 import argparse
+import asyncio
+import bisect
+import collections
+import contextlib
 import datetime
 import itertools
 import json
 import os
+import random
 import re
 import sqlite3
+import statistics
 import sys
+import tempfile
+import threading
 import time
-import concurrent.futures as cf
+import aiohttp
 import requests
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 # https://dev.twitch.tv/console/apps/create
 USER_ENDPOINT = "https://api.twitch.tv/helix/users"
+TOKEN_ENDPOINT = "https://id.twitch.tv/oauth2/token"
 
+# Rows written per transaction (100 requests of 100 users) and SQLite page cache per connection
+COMMIT_ROWS = 10000
+BATCH_SIZE = 100
+CACHE_KIB = 256 * 1024
 
-def progressbar(it, prefix="", size=60, file=sys.stdout, count=None, multiplier=1):
+# Every user starts out believed to change about once a year, a weak belief worth about a month of checks
+PRIOR_CHANGES = 0.1
+PRIOR_DAYS = 36.5
+
+UPSERT_USERS = """
+    INSERT INTO users(ID,username,display_name) VALUES (?,?,?)
+    ON CONFLICT(ID) DO UPDATE SET username=excluded.username,display_name=excluded.display_name
+"""
+
+
+def progressbar(it, prefix="", size=60, file=sys.stdout, count=None, multiplier=1, position=None):
     def show(j):
-        x = int(size * j / count)
+        x = min(size, int(size * j / count)) if count else size
         file.write("%s[%s%s] %i/%i\r" % (prefix, "#" * x, "." * (size - x), j, count))
         file.flush()
 
     show(0)
     for i, item in enumerate(it):
         yield item
-        show((i + 1) * multiplier)
+        show(position() if position else (i + 1) * multiplier)
     file.write("\n")
     file.flush()
 
 
+class Histogram:
+    # Upper bounds in seconds, wide enough for both SQLite commits and rate limited requests
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q quantile, "+Inf" past the last bucket so it stays valid JSON"""
+        if not self.count:
+            return None
+
+        target = q * self.count
+        for bound, cumulative in zip(self.BUCKETS + ("+Inf",), itertools.accumulate(self.counts)):
+            if cumulative >= target:
+                return bound
+
+
+class Metrics:
+    """
+    Counters and histograms for a load or check run
+
+    Reported as JSON lines every few seconds and/or served as Prometheus text, which shows whether a run is waiting
+    on HTTP, on the rate limit or on SQLite. Updated from the fetch loop and read from the reporting threads.
+    """
+    PREFIX = "twitch_"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self.lock:
+            self.histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            snapshot = {"time": datetime.datetime.now().isoformat(timespec="seconds"), "elapsed": round(elapsed, 3)}
+            snapshot.update(self.counters)
+            snapshot["users_per_second"] = round(self.counters["users_fetched_total"] / elapsed, 2) if elapsed else 0.0
+            for name, histogram in self.histograms.items():
+                snapshot[name] = {
+                    "count": histogram.count,
+                    "mean": round(histogram.sum / histogram.count, 6) if histogram.count else None,
+                    "p50": histogram.quantile(0.5),
+                    "p95": histogram.quantile(0.95),
+                }
+            return snapshot
+
+    def prometheus(self):
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines += [f"# TYPE {self.PREFIX}{name} counter", f"{self.PREFIX}{name} {value}"]
+
+            elapsed = time.monotonic() - self.started
+            lines += [
+                f"# TYPE {self.PREFIX}users_per_second gauge",
+                f"{self.PREFIX}users_per_second {self.counters['users_fetched_total'] / elapsed if elapsed else 0.0}",
+            ]
+
+            for name, histogram in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {self.PREFIX}{name} histogram")
+                for bound, cumulative in zip(Histogram.BUCKETS + ("+Inf",), itertools.accumulate(histogram.counts)):
+                    lines.append(f'{self.PREFIX}{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines += [f"{self.PREFIX}{name}_sum {histogram.sum}", f"{self.PREFIX}{name}_count {histogram.count}"]
+        return "\n".join(lines) + "\n"
+
+    def report(self, file, interval):
+        """Write a JSON snapshot to file every interval seconds, returns a function that stops after a final one"""
+        stop = threading.Event()
+        previous = [0, 0.0]
+
+        def write():
+            snapshot = self.snapshot()
+            users, elapsed = snapshot.get("users_fetched_total", 0), snapshot["elapsed"]
+            # users_per_second averages the whole run, this shows the last interval
+            snapshot["users_per_second_recent"] = (
+                round((users - previous[0]) / (elapsed - previous[1]), 2) if elapsed > previous[1] else 0.0
+            )
+            previous[:] = users, elapsed
+            print(json.dumps(snapshot), file=file, flush=True)
+
+        def run():
+            while not stop.wait(interval):
+                write()
+            write()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        def close():
+            stop.set()
+            thread.join()
+        return close
+
+    def serve(self, port):
+        """Serve Prometheus text on http://127.0.0.1:port/metrics from a background thread"""
+        server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+        server.metrics = self
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.metrics.prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+metrics = Metrics()
+
+
+class Retry:
+    """
+    Retry policy for a single request, exponential backoff with full jitter
+
+    Holds no per-request state, the caller keeps its own attempt number, so one policy is safely shared by
+    concurrent requests. Server hints (Retry-After, or Ratelimit-Reset on a 429) take precedence over backoff.
+    """
+    STATUSES = {429, 500, 502, 503, 504}
+
+    def __init__(self, attempts=5, base=0.5, cap=30):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+    def delay(self, attempt, status=None, headers=None):
+        """Seconds to wait before retrying, None if the response is final or attempts are used up"""
+        if attempt + 1 >= self.attempts or (status is not None and status not in self.STATUSES):
+            return None
+
+        headers = headers or {}
+        if "Retry-After" in headers:
+            try:
+                return max(0.0, float(headers["Retry-After"]))
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(headers["Retry-After"]).timestamp() - time.time())
+
+        if status == 429 and "Ratelimit-Reset" in headers:
+            # Jitter spreads out the callers that all wake at the same reset
+            return max(0.0, int(headers["Ratelimit-Reset"]) - time.time()) + random.uniform(0, self.base)
+
+        return self.backoff(attempt)
+
+
 class Twitch:
-    def __init__(self, client_id, client_secret, secret_json="secrets.json"):
+    def __init__(self, client_id, client_secret, secret_json="secrets.json", endpoint=USER_ENDPOINT,
+                 token_endpoint=TOKEN_ENDPOINT, retry=None, timeout=(5, 30)):
         self.client_id = client_id
         self.client_secret = client_secret
         self.secret_json = secret_json
+        self.endpoint = endpoint
+        self.token_endpoint = token_endpoint
+
+        # One keep-alive connection reused for every batch instead of a new TCP+TLS handshake each time
+        self.session = requests.Session()
+        self.headers = None
+        self.retry = retry or Retry()
+        # (connect, read) seconds, a stalled connection raises and goes through the retry policy instead of hanging
+        self.timeout = timeout
 
         self.rate_limit_max = None
         self.rate_limit_remaining = None
         self.rate_limit_reset = None
 
-        self.attempts = 0
         if os.path.isfile(secret_json):
             with open(secret_json, "r") as r:
                 secrets = json.load(r)
@@ -48,19 +266,29 @@ class Twitch:
             self.token = None
             self.token_expire = None
 
-    def get_access_token(self):
-        if self.token is not None and datetime.datetime.now() < self.token_expire:
-            return self.token
+    def token_expired(self):
+        return self.token is None or datetime.datetime.now() >= self.token_expire
 
-        r = requests.post("https://id.twitch.tv/oauth2/token", params={
+    def token_params(self):
+        return {
             "client_id": self.client_id,
             "client_secret": self.client_secret,
             "grant_type": "client_credentials"
-        })
+        }
+
+    def get_access_token(self):
+        if not self.token_expired():
+            return self.token
+
+        r = self.session.post(self.token_endpoint, params=self.token_params(), timeout=self.timeout)
         r.raise_for_status()
-        j = r.json()
+        return self.set_token(r.json())
+
+    def set_token(self, j):
+        """Store a token response from the token endpoint and save it to secret_json"""
         self.token = j["access_token"]
         self.token_expire = datetime.datetime.now() + datetime.timedelta(seconds=j["expires_in"])
+        self.headers = None
 
         with open(self.secret_json, "w") as w:
             json.dump({
@@ -70,33 +298,285 @@ class Twitch:
 
         return self.token
 
+    def auth_headers(self):
+        """Request headers, only rebuilt when the access token changes"""
+        token = self.get_access_token()
+        if self.headers is None:
+            self.headers = {
+                "Client-Id": self.client_id,
+                "Authorization": f"Bearer {token}"
+            }
+        return self.headers
+
+    def invalidate_token(self, headers):
+        """Forget a token the server rejected so the next request fetches a new one, unless it was already replaced"""
+        if headers is self.headers:
+            self.token = None
+            self.headers = None
+
     def get(self, *args, **kwargs):
-        header = {
-            "Client-Id": self.client_id,
-            "Authorization": f"Bearer {self.get_access_token()}"
-        }
-        kwargs.update(headers=header)
+        attempt = 0
+        while True:
+            headers = self.auth_headers()
+            limited = False
+            metrics.inc("requests_total")
+            try:
+                with metrics.timer("request_seconds"):
+                    r = self.session.get(*args, headers=headers, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                delay = self.retry.delay(attempt)
+                if delay is None:
+                    raise
+            else:
+                if r.status_code == 401 and attempt == 0:
+                    self.invalidate_token(headers)
+                    attempt += 1
+                    continue
 
-        r = requests.get(*args, **kwargs)
-        if r.status_code not in [429, 200] and self.attempts < 5:
-            self.attempts += 1
-            return self.get(*args, **kwargs)
+                if "Ratelimit-Remaining" in r.headers:
+                    self.rate_limit_max = int(r.headers["Ratelimit-Limit"])
+                    self.rate_limit_remaining = int(r.headers["Ratelimit-Remaining"])
+                    self.rate_limit_reset = int(r.headers["Ratelimit-Reset"])
 
-        self.rate_limit_max = int(r.headers["Ratelimit-Limit"])
-        self.rate_limit_remaining = int(r.headers["Ratelimit-Remaining"])
-        self.rate_limit_reset = datetime.datetime.fromtimestamp(int(r.headers["Ratelimit-Reset"]))
+                if r.status_code == 200:
+                    # Wait out an empty bucket now rather than spend the next request on a 429
+                    if self.rate_limit_remaining is not None and self.rate_limit_remaining <= 0:
+                        delay = max(0.0, self.rate_limit_reset - time.time())
+                        metrics.inc("rate_limit_sleeps_total")
+                        metrics.inc("rate_limit_sleep_seconds_total", delay)
+                        time.sleep(delay)
+                    return r
 
-        if self.rate_limit_remaining <= 0:
-            print("Sleeping: ", (self.rate_limit_reset - datetime.datetime.utcnow()).seconds)
-            time.sleep((self.rate_limit_reset - datetime.datetime.utcnow()).seconds)
+                limited = r.status_code == 429
+                delay = self.retry.delay(attempt, r.status_code, r.headers)
+                if delay is None:
+                    r.raise_for_status()
+                    return r
 
-        if r.status_code == 429:
-            self.attempts += 1
-            return self.get(*args, **kwargs)
+            metrics.inc("retries_total")
+            if limited:
+                metrics.inc("rate_limit_sleeps_total")
+                metrics.inc("rate_limit_sleep_seconds_total", delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def fetch(self, batches):
+        """Yield (users, data) for each batch of users, one request at a time, data is None when the request failed"""
+        for users in batches:
+            try:
+                data = self.get(users_to_urls(users, self.endpoint)).json()["data"]
+            except Exception as e:
+                print(f"Error getting {users}: {e}")
+                metrics.inc("errors_total")
+                data = None
+            yield users, data
+
+
+class TokenBucket:
+    """
+    Request budget shared by every in-flight request of an AsyncTwitch, used as `async with bucket:` around a request
+
+    Refills continuously at limit / period tokens a second, like Helix's own bucket, and is resynced from the
+    Ratelimit-* headers of each response so concurrent requests spend the whole budget without overdrawing it.
+    """
+
+    def __init__(self, limit=800, period=60):
+        self.limit = limit
+        self.period = period
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.outstanding = 0
+        self.lock = asyncio.Lock()
+
+    def attach(self):
+        """Start handing out tokens on a new event loop, the budget carries over but an asyncio lock can't"""
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.period)
+        self.updated = now
+
+    async def __aenter__(self):
+        # Sleeping while holding the lock hands tokens out in the order they were asked for
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) * self.period / self.limit
+                metrics.inc("rate_limit_sleeps_total")
+                metrics.inc("rate_limit_sleep_seconds_total", delay)
+                await asyncio.sleep(delay)
+                self._refill()
+            self.tokens -= 1
+            self.outstanding += 1
+        return self
+
+    async def __aexit__(self, *exc):
+        self.outstanding -= 1
+
+    def update(self, headers):
+        if "Ratelimit-Remaining" not in headers:
+            return
+
+        # The server hasn't counted the other requests still in flight, they were already taken locally
+        self._refill()
+        self.limit = int(headers["Ratelimit-Limit"])
+        self.tokens = min(self.tokens, int(headers["Ratelimit-Remaining"]) - (self.outstanding - 1))
+
+
+class AsyncTwitch(Twitch):
+    """Twitch client keeping up to concurrency requests in flight on one pooled aiohttp session"""
+
+    def __init__(self, *args, concurrency=8, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.concurrency = concurrency
+        self.bucket = TokenBucket()
+        self.token_lock = None
+
+    async def async_auth_headers(self, session):
+        """auth_headers, but an expired token is refreshed on the aiohttp session instead of blocking the event loop"""
+        if self.token_expired():
+            # Only the first request to find the token expired fetches a new one, the rest wait for it
+            async with self.token_lock:
+                if self.token_expired():
+                    async with session.post(self.token_endpoint, params=self.token_params()) as r:
+                        r.raise_for_status()
+                        self.set_token(await r.json())
+        return self.auth_headers()
+
+    async def get_json(self, session, url):
+        attempt = 0
+        while True:
+            headers = await self.async_auth_headers(session)
+            limited = False
+            try:
+                async with self.bucket:
+                    metrics.inc("requests_total")
+                    start = time.perf_counter()
+                    async with session.get(url, headers=headers) as r:
+                        metrics.observe("request_seconds", time.perf_counter() - start)
+                        self.bucket.update(r.headers)
+                        if r.status == 200:
+                            return await r.json()
+
+                        if r.status == 401 and attempt == 0:
+                            self.invalidate_token(headers)
+                            attempt += 1
+                            continue
+
+                        limited = r.status == 429
+                        delay = self.retry.delay(attempt, r.status, r.headers)
+                        if delay is None:
+                            r.raise_for_status()
+                            return await r.json()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                delay = self.retry.delay(attempt)
+                if delay is None:
+                    raise
+
+            metrics.inc("retries_total")
+            if limited:
+                metrics.inc("rate_limit_sleeps_total")
+                metrics.inc("rate_limit_sleep_seconds_total", delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _get_users(self, session, users):
+        try:
+            return users, (await self.get_json(session, users_to_urls(users, self.endpoint)))["data"]
+        except Exception as e:
+            print(f"Error getting {users}: {e}")
+            metrics.inc("errors_total")
+            return users, None
+
+    async def _session(self):
+        connect, read = self.timeout
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+        )
+
+    def fetch(self, batches):
+        """
+        Yield (users, data) for each batch of users in order, keeping up to concurrency requests in flight, data is
+        None when the request failed
+
+        The event loop only runs while waiting on the oldest request, so the caller can write each batch
+        to the database synchronously while the rest stay queued on their sockets.
+        """
+        loop = asyncio.new_event_loop()
+        session = loop.run_until_complete(self._session())
+        # Locks bind to the loop they are first used on and each fetch runs its own loop
+        self.bucket.attach()
+        self.token_lock = asyncio.Lock()
+        pending = collections.deque()
+        try:
+            for users in batches:
+                pending.append(loop.create_task(self._get_users(session, users)))
+                if len(pending) >= self.concurrency:
+                    yield loop.run_until_complete(pending.popleft())
+
+            while pending:
+                yield loop.run_until_complete(pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.wait(pending))
+            loop.run_until_complete(session.close())
+            loop.close()
+
+
+class MockHelixHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle would hold the body for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        time.sleep(self.server.handshake)
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body):
+        body = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Ratelimit-Limit", str(self.server.limit))
+        self.send_header("Ratelimit-Remaining", str(self.server.limit))
+        self.send_header("Ratelimit-Reset", str(int(time.time())))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        ids = parse_qs(urlparse(self.path).query).get("id", [])
+        self.send_json({"data": [{"id": i, "login": f"user{i}", "display_name": f"User{i}"} for i in ids]})
+
+    def do_POST(self):
+        self.send_json({"access_token": "mock", "expires_in": 3600})
 
-        r.raise_for_status()
-        self.attempts = 0
-        return r
+
+class MockHelix(ThreadingHTTPServer):
+    """
+    Local stand-in for the Helix users and token endpoints, for benchmarking without spending API budget
+
+    latency seconds are added to every response and handshake seconds once per new connection, approximating
+    the TCP+TLS setup a real connection to api.twitch.tv pays.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.02, handshake=0.05, limit=800):
+        super().__init__(("127.0.0.1", 0), MockHelixHandler)
+        self.latency = latency
+        self.handshake = handshake
+        self.limit = limit
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
 
 
 def grouper(n, iterable):
@@ -104,8 +584,45 @@ def grouper(n, iterable):
     return iter(lambda: list(itertools.islice(iterable, n)), [])
 
 
-def setup_db(args):
-    cur = args.database.cursor()
+def connect(database):
+    """Open the database in WAL mode with the per-connection settings"""
+    connection = sqlite3.connect(database)
+    # WAL is persisted in the file but databases set up before it was enabled are still in rollback mode
+    connection.execute("PRAGMA journal_mode=WAL")
+    # In WAL mode NORMAL only syncs at checkpoints, a power loss can drop the last commits but not corrupt the file
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA cache_size=-{CACHE_KIB}")
+    create_run_tables(connection)
+    return connection
+
+
+def create_run_tables(connection):
+    """Tables for resuming and scheduling runs, also created on connect for databases set up before they existed"""
+    cur = connection.cursor()
+
+    # Times are julian days
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS check_schedule (
+            ID int UNSIGNED PRIMARY KEY,
+            first_checked real NOT NULL,
+            last_checked real NOT NULL,
+            changes int NOT NULL DEFAULT 0
+        )
+    """)
+
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS checkpoints (
+            name varchar(254) PRIMARY KEY,
+            last_id int UNSIGNED NOT NULL,
+            batches int NOT NULL,
+            updated_at timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def create_schema(connection):
+    cur = connection.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
 
     cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -151,61 +668,327 @@ def setup_db(args):
        END;
     """)
 
+    # Change history per user in time order, and who used to have a name
+    cur.execute("CREATE INDEX IF NOT EXISTS username_changes_user ON users_username_changes(userID, found_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS display_name_changes_user ON users_display_name_changes(userID, found_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS username_changes_old ON users_username_changes(username_old, found_at)")
+
+    create_run_tables(connection)
+
+
+def setup_db(args):
+    create_schema(args.database)
     print("Setup DB")
 
 
-def get_ids(file, pattern):
-    with open(file) as r:
-        for line in r:
-            match = re.search(pattern, line)
-            if match:
-                yield match.group("id"), match.group("username")
+def get_ids(lines, pattern):
+    pattern = re.compile(pattern)
+    for line in lines:
+        match = pattern.search(line)
+        if match:
+            yield match.group("id"), match.group("username")
+
+
+def client(args):
+    if args.concurrency > 1:
+        return AsyncTwitch(args.client, args.secret, concurrency=args.concurrency)
+    return Twitch(args.client, args.secret)
 
 
 def load_file(args):
-    twitch = Twitch(args.client, args.secret)
-    cursor = args.database.cursor()
+    checkpoint = f"load:{os.path.abspath(args.file)}"
+    _, done = (0, 0) if args.restart else get_checkpoint(args.database, checkpoint)
 
-    ids = list(get_ids(args.file, args.pattern))
-    for i,users in enumerate(progressbar(grouper(100, ids), count=len(ids)//100)):
-        get_users(twitch, cursor, users)
+    with open(args.file) as r:
+        # Progress is the byte offset the decoder has read up to, the file is never counted or held in memory
+        size = os.fstat(r.fileno()).st_size
+        # Dump files aren't sorted by ID, so resume by skipping the batches already committed
+        batches = itertools.islice(grouper(BATCH_SIZE, get_ids(r, args.pattern)), done, None)
+        update_users(args, batches, size, position=r.buffer.tell, checkpoint=checkpoint, done=done,
+                     known=lambda users: stored_users(args.database, users))
 
-        if i % 100 == 0:
-            args.database.commit()
-    args.database.commit()
 
+def users_to_urls(users, endpoint=USER_ENDPOINT):
+    return f"{endpoint}?{'&'.join(f'id={int(i[0])}' for i in users)}"
 
-def users_to_urls(users):
-    return f"{USER_ENDPOINT}?{'&'.join(f'id={int(i[0])}' for i in users)}"
 
+def get_checkpoint(connection, name):
+    """(last_id, batches) committed by an interrupted run called name, (0, 0) if there isn't one"""
+    row = connection.execute("SELECT last_id, batches FROM checkpoints WHERE name=?", (name,)).fetchone()
+    return row or (0, 0)
 
-def get_users(twitch, cursor, users):
-    try:
-        r = twitch.get(users_to_urls(users))
-    except Exception as e:
-        return print(f"Error getting {users}: {e}")
 
-    for entry in r.json()["data"]:
-        cursor.execute("""
-            INSERT INTO users(ID,username,display_name) VALUES (?,?,?) 
-            ON CONFLICT(ID) DO UPDATE SET username=excluded.username,display_name=excluded.display_name;
-        """, (entry["id"], entry["login"], entry["display_name"]))
+def julian_now():
+    return time.time() / 86400 + 2440587.5
+
+
+def store_users(connection, rows, checkpoint=None, checked=()):
+    """
+    Upsert (id, login, display_name) rows in a single transaction
+
+    Along with a (name, last_id, batches) checkpoint and the (id, checked_at, changed) result of every user checked.
+    """
+    with metrics.timer("db_commit_seconds"), connection:
+        connection.executemany(UPSERT_USERS, rows)
+        connection.executemany("""
+            INSERT INTO check_schedule(ID,first_checked,last_checked,changes) VALUES (?1,?2,?2,?3)
+            ON CONFLICT(ID) DO UPDATE SET last_checked=excluded.last_checked,changes=changes+excluded.changes
+        """, checked)
+        if checkpoint is not None:
+            connection.execute("""
+                INSERT INTO checkpoints(name,last_id,batches) VALUES (?,?,?)
+                ON CONFLICT(name) DO UPDATE SET last_id=excluded.last_id,batches=excluded.batches,
+                                                updated_at=CURRENT_TIMESTAMP
+            """, checkpoint)
+
+
+def stored_users(connection, users):
+    """The stored (ID, username, display_name) rows of a batch of users"""
+    return connection.execute(
+        f"SELECT ID, username, display_name FROM users WHERE ID IN ({','.join('?' * len(users))})",
+        [int(user[0]) for user in users]
+    ).fetchall()
+
+
+def changed_rows(known, data):
+    """(id, login, display_name) rows of fetched users that are new or differ from the known rows"""
+    known = {row[0]: row[1:] for row in known}
+    return [
+        (entry["id"], entry["login"], entry["display_name"]) for entry in data
+        if known.get(int(entry["id"])) != (entry["login"], entry["display_name"])
+    ]
+
+
+def update_users(args, batches, count, position=None, checkpoint=None, done=0, known=None, schedule=False):
+    """
+    Fetch batches of users and upsert them, with a checkpoint every COMMIT_ROWS // BATCH_SIZE batches
+
+    known(users) returns the stored rows of a batch, fetched users matching them exactly aren't written at all,
+    unless --write-all is given. With schedule every checked user's result is recorded in check_schedule.
+    """
+    twitch = client(args)
+
+    rows = []
+    checked = []
+    fetched = written = renamed = failed = 0
+    for users, data in progressbar(twitch.fetch(batches), count=count, position=position):
+        if data is None:
+            # Nothing is known about a batch that failed, so it mustn't look like a check that found no change
+            failed += 1
+            data = []
+            checked_users = ()
+        else:
+            checked_users = users
+
+        fetched_rows = [(entry["id"], entry["login"], entry["display_name"]) for entry in data]
+        changed = fetched_rows if known is None else changed_rows(known(users), data)
+        rows.extend(fetched_rows if args.write_all else changed)
+
+        if schedule:
+            now = julian_now()
+            changed_ids = {int(row[0]) for row in changed}
+            checked.extend((int(user[0]), now, int(user[0]) in changed_ids) for user in checked_users)
+
+        fetched += len(data)
+        written += len(fetched_rows if args.write_all else changed)
+        renamed += len(changed)
+        done += 1
+
+        metrics.inc("batches_total")
+        metrics.inc("users_fetched_total", len(data))
+        metrics.inc("users_written_total", len(fetched_rows if args.write_all else changed))
+        metrics.inc("users_changed_total", len(changed))
+
+        if done % (COMMIT_ROWS // BATCH_SIZE) == 0:
+            # The checkpoint stops before the first failed batch, so the next run fetches it again
+            resume = (checkpoint, users[-1][0], done) if checkpoint and not failed else None
+            store_users(args.database, rows, resume, checked)
+            rows = []
+            checked = []
+    store_users(args.database, rows, checked=checked)
+    print(f"Wrote {written} of {fetched} fetched users, {renamed} new or changed, {failed} batches failed",
+          file=sys.stderr)
+
+    if checkpoint and failed:
+        print("Run again to retry the failed batches from the last checkpoint before them", file=sys.stderr)
+    elif checkpoint:
+        # Finished, the next run starts from the beginning
+        with args.database:
+            args.database.execute("DELETE FROM checkpoints WHERE name=?", (checkpoint,))
+
+
+def user_pages(connection, after=0, size=BATCH_SIZE):
+    """Batches of (ID, username, display_name) rows with IDs above after, one range scan of the primary key per batch"""
+    while True:
+        page = connection.execute(
+            "SELECT ID, username, display_name FROM users WHERE ID > ? ORDER BY ID LIMIT ?", (after, size)
+        ).fetchall()
+        if not page:
+            return
+        yield page
+        after = page[-1][0]
+
+
+def schedule_users(connection, budget, explore):
+    """
+    Pick budget users to check into the temp table picked, in the order they should be checked
+
+    Users that have never been checked have no history to rank them by, so they always go first. The explore share
+    of the budget then goes to the users checked longest ago, so quiet users are still looked at now and then. The
+    rest assumes each user changes as a Poisson process at the rate seen so far, shrunk towards PRIOR_CHANGES /
+    PRIOR_DAYS. The chance a user has changed since its last check grows with rate * elapsed time, so they are
+    ranked by that product.
+    """
+    connection.execute("DROP TABLE IF EXISTS temp.picked")
+    connection.execute("CREATE TEMP TABLE picked (ID int PRIMARY KEY, username, display_name)")
+
+    def remaining():
+        return budget - connection.execute("SELECT count(*) FROM picked").fetchone()[0]
+
+    with connection:
+        connection.execute("""
+            INSERT INTO picked
+            SELECT users.ID, username, display_name FROM users LEFT JOIN check_schedule ON check_schedule.ID = users.ID
+            WHERE check_schedule.ID IS NULL LIMIT ?
+        """, (budget,))
+
+        connection.execute("""
+            INSERT INTO picked
+            SELECT users.ID, username, display_name FROM users JOIN check_schedule ON check_schedule.ID = users.ID
+            ORDER BY last_checked LIMIT ?
+        """, (min(remaining(), int(budget * explore)),))
+
+        connection.execute("""
+            INSERT INTO picked
+            SELECT users.ID, username, display_name FROM users JOIN check_schedule ON check_schedule.ID = users.ID
+            WHERE users.ID NOT IN (SELECT ID FROM picked)
+            ORDER BY (changes + ?) / (last_checked - first_checked + ?) * (? - last_checked) DESC LIMIT ?
+        """, (PRIOR_CHANGES, PRIOR_DAYS, julian_now(), remaining()))
+
+    return budget - remaining()
+
+
+def picked_pages(connection, size=BATCH_SIZE):
+    """Batches of (ID, username, display_name) rows from picked, in the order they were picked"""
+    after = 0
+    while True:
+        page = connection.execute(
+            "SELECT rowid, ID, username, display_name FROM picked WHERE rowid > ? ORDER BY rowid LIMIT ?", (after, size)
+        ).fetchall()
+        if not page:
+            return
+        yield [row[1:] for row in page]
+        after = page[-1][0]
 
 
 def check_twitch(args):
-    twitch = Twitch(args.client, args.secret)
-    read_cur = args.database.cursor()
-    edit_cur = args.database.cursor()
+    if args.budget:
+        # A budgeted run picks its own users, there is nothing to resume
+        picked = schedule_users(args.database, args.budget * BATCH_SIZE, args.explore)
+        update_users(args, picked_pages(args.database), -(-picked // BATCH_SIZE), known=lambda users: users,
+                     schedule=True)
+        return
+
+    after, done = (0, 0) if args.restart else get_checkpoint(args.database, "check")
+    if done:
+        print(f"Resuming after ID {after}, {done} batches already checked", file=sys.stderr)
+
+    remaining = args.database.execute("SELECT count(*) FROM users WHERE ID > ?", (after,)).fetchone()[0]
+    # Each page already holds the stored names to compare against
+    update_users(args, user_pages(args.database, after), -(-remaining // BATCH_SIZE), checkpoint="check", done=done,
+                 known=lambda users: users, schedule=True)
+
+
+def time_requests(get, urls):
+    timings = []
+    for url in urls:
+        start = time.perf_counter()
+        get(url).raise_for_status()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def bench_http(args):
+    server = MockHelix(args.latency / 1000, args.handshake / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    endpoint = f"{server.url}/helix/users"
+    urls = [users_to_urls(users, endpoint) for users in grouper(100, ((i,) for i in range(args.batches * 100)))]
+
+    with tempfile.TemporaryDirectory() as directory:
+        twitch = Twitch("mock", "mock", os.path.join(directory, "secrets.json"), endpoint, f"{server.url}/oauth2/token")
+        headers = twitch.auth_headers()
+
+        results = {
+            "requests.get": time_requests(lambda url: requests.get(url, headers=dict(headers)), urls),
+            "Twitch.session": time_requests(twitch.get, urls),
+        }
+    server.shutdown()
 
-    read_cur.execute("SELECT ID from users")
-    ids = read_cur.fetchall()
+    print(f"{args.batches} batches, {args.latency}ms response latency, {args.handshake}ms handshake")
+    print(f"{'':<16}{'mean':>10}{'p50':>10}{'p95':>10}{'total':>10}")
+    for name, timings in results.items():
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        print(f"{name:<16}{statistics.mean(timings) * 1000:>8.1f}ms{statistics.median(timings) * 1000:>8.1f}ms"
+              f"{p95 * 1000:>8.1f}ms{sum(timings):>9.2f}s")
 
-    for i, users in enumerate(progressbar(grouper(100, ids), count=len(ids)//100)):
-        get_users(twitch, edit_cur, users)
 
-        if i % 100 == 0:
-            args.database.commit()
-    args.database.commit()
+def upsert_each(connection, rows):
+    """The per-row upsert store_users replaced, committing every COMMIT_ROWS rows, kept for bench-db"""
+    cursor = connection.cursor()
+    for i, row in enumerate(rows):
+        cursor.execute(UPSERT_USERS, row)
+
+        if (i + 1) % COMMIT_ROWS == 0:
+            connection.commit()
+    connection.commit()
+
+
+def upsert_batched(connection, rows):
+    for chunk in grouper(COMMIT_ROWS, rows):
+        store_users(connection, chunk)
+
+
+def bench_db(args):
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as directory:
+        connection = connect(os.path.join(directory, "bench.db"))
+        create_schema(connection)
+
+        start = time.perf_counter()
+        for ids in grouper(COMMIT_ROWS * 10, range(args.users)):
+            store_users(connection, ((i, f"user{i}", f"User{i}") for i in ids))
+        print(f"Loaded {args.users} users in {time.perf_counter() - start:.1f}s")
+
+        def updates():
+            # A check run's worth of random existing users, a few of which were renamed
+            return [
+                (i, f"renamed{i}" if rng.random() < args.renamed else f"user{i}", f"User{i}")
+                for i in rng.sample(range(args.users), args.rows)
+            ]
+
+        modes = {
+            "execute, rollback journal": ("DELETE", "FULL", 2000, upsert_each),
+            "executemany, WAL": ("WAL", "NORMAL", CACHE_KIB, upsert_batched),
+        }
+        # Alternate the modes so neither always runs against the warmer page cache, keep the best round
+        best = dict.fromkeys(modes, 0.0)
+        for _ in range(args.repeat):
+            for name, (journal, synchronous, cache, upsert) in modes.items():
+                connection.execute(f"PRAGMA journal_mode={journal}")
+                connection.execute(f"PRAGMA synchronous={synchronous}")
+                connection.execute(f"PRAGMA cache_size=-{cache}")
+
+                rows = updates()
+                start = time.perf_counter()
+                upsert(connection, rows)
+                best[name] = max(best[name], len(rows) / (time.perf_counter() - start))
+
+        for name, rate in best.items():
+            print(f"{name:<28}{rate:>12,.0f} rows/s")
+
+        connection.close()
 
 
 def get_changes(changes_l):
@@ -221,13 +1004,12 @@ def get_changes(changes_l):
 def changes(args):
     cursor = args.database.cursor()
 
-    cursor.execute("SELECT * FROM users_username_changes WHERE userID=?", (args.id,))
+    # The (userID, found_at) indexes return rows already in order, rowid breaks ties within the same second
+    cursor.execute("SELECT * FROM users_username_changes WHERE userID=? ORDER BY found_at, rowid", (args.id,))
     username_changes = cursor.fetchall()
-    username_changes.sort(key=lambda x: datetime.datetime.fromisoformat(x[4]))
 
-    cursor.execute("SELECT * FROM users_display_name_changes WHERE userID=?", (args.id,))
+    cursor.execute("SELECT * FROM users_display_name_changes WHERE userID=? ORDER BY found_at, rowid", (args.id,))
     display_changes = cursor.fetchall()
-    display_changes.sort(key=lambda x: datetime.datetime.fromisoformat(x[4]))
 
     print("Username Changes:")
     for i, c in enumerate(get_changes(username_changes)):
@@ -238,9 +1020,26 @@ def changes(args):
         print(f"\t{i + 1}: {c}")
 
 
+def previous(args):
+    cursor = args.database.cursor()
+    cursor.execute("""
+        SELECT userID, username_new, found_at FROM users_username_changes
+        WHERE username_old=? ORDER BY found_at, rowid
+    """, (args.username,))
+
+    print(f"Previous users of {args.username}:")
+    for i, (user_id, username_new, found_at) in enumerate(cursor):
+        print(f"\t{i + 1}: {user_id} renamed to {username_new} by {found_at}")
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--database", type=sqlite3.connect, default="twitch.db")
+    parser.add_argument("--database", type=connect, default="twitch.db")
+    parser.add_argument("--metrics-interval", type=float, help="Write a JSON line of run metrics every this many "
+                                                                 "seconds")
+    parser.add_argument("--metrics-file", type=argparse.FileType("a"), default=sys.stderr,
+                        help="Where --metrics-interval lines go, defaults to stderr")
+    parser.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on 127.0.0.1:PORT/metrics")
     subparsers = parser.add_subparsers(title="Subcommands")
 
     setup_parser = subparsers.add_parser("setup")
@@ -254,16 +1053,54 @@ if __name__ == "__main__":
                                                "which applied on each line of the file", default=r"^(?P<username>["
                                                                                                  r"^:]+)\:(?P<id>["
                                                                                                  r"0-9]+)\:.+$")
+    load_parser.add_argument("--concurrency", type=int, default=8, help="Requests kept in flight, 1 is sequential")
+    load_parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted run")
+    load_parser.add_argument("--write-all", action="store_true", help="Upsert every fetched user, even unchanged ones")
     load_parser.set_defaults(func=load_file)
 
     twitch_parser = subparsers.add_parser("check")
     twitch_parser.add_argument("--client", help="Twitch Developer ClientID")
     twitch_parser.add_argument("--secret", help="Twitch Developer Secret")
+    twitch_parser.add_argument("--concurrency", type=int, default=8, help="Requests kept in flight, 1 is sequential")
+    twitch_parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of an interrupted run")
+    twitch_parser.add_argument("--write-all", action="store_true", help="Upsert every fetched user, even unchanged ones")
+    twitch_parser.add_argument("--budget", type=int, help="Only spend this many requests, on the users most likely "
+                                                          "to have changed, instead of checking everyone")
+    twitch_parser.add_argument("--explore", type=float, default=0.1, help="Share of --budget spent on the users "
+                                                                          "checked longest ago")
     twitch_parser.set_defaults(func=check_twitch)
 
+    bench_parser = subparsers.add_parser("bench-http", help="Compare per-batch latency of fresh connections and the "
+                                                            "pooled session against a local mock Helix server")
+    bench_parser.add_argument("--batches", type=int, default=200)
+    bench_parser.add_argument("--latency", type=float, default=20, help="Server response time in ms")
+    bench_parser.add_argument("--handshake", type=float, default=50, help="Added cost of a new connection in ms")
+    bench_parser.set_defaults(func=bench_http)
+
+    bench_db_parser = subparsers.add_parser("bench-db", help="Compare per-row and batched upsert throughput on a "
+                                                             "scratch database")
+    bench_db_parser.add_argument("--users", type=int, default=10_000_000, help="Users in the scratch database")
+    bench_db_parser.add_argument("--rows", type=int, default=200_000, help="Rows upserted per mode")
+    bench_db_parser.add_argument("--renamed", type=float, default=0.01, help="Fraction of upserted rows with a new name")
+    bench_db_parser.add_argument("--dir", help="Directory for the scratch database, defaults to the system temp dir")
+    bench_db_parser.add_argument("--repeat", type=int, default=3, help="Keep the best of this many rounds")
+    bench_db_parser.add_argument("--seed", type=int, default=0)
+    bench_db_parser.set_defaults(func=bench_db)
+
     twitch_parser = subparsers.add_parser("changes")
     twitch_parser.add_argument("id", type=int)
     twitch_parser.set_defaults(func=changes)
 
+    previous_parser = subparsers.add_parser("previous", help="Find the users who previously had a username")
+    previous_parser.add_argument("username")
+    previous_parser.set_defaults(func=previous)
+
     arguments = parser.parse_args()
-    arguments.func(arguments)
+    if arguments.metrics_port:
+        metrics.serve(arguments.metrics_port)
+    stop_reporting = metrics.report(arguments.metrics_file, arguments.metrics_interval) if arguments.metrics_interval else None
+    try:
+        arguments.func(arguments)
+    finally:
+        if stop_reporting:
+            stop_reporting()